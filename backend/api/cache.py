@@ -0,0 +1,280 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.utils.module_loading import import_string
+from rest_framework.response import Response
+
+from recipes.models import TableVersion
+
+DEFAULT_BACKEND = 'api.cache.LRUCacheBackend'
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TIMEOUT = 300
+KEY_PREFIX = 'recipes'
+# Справочники меняет только админ: клиент может не перепроверять их час
+REFERENCE_MAX_AGE = 60 * 60
+
+
+def initial_version():
+    """ Начальная версия - время в мкс
+
+    Если общий кэш вытеснил счетчик версии, новый начнется с числа
+    больше всех выданных прежде, и старые страницы не оживут.
+    """
+    return time.time_ns() // 1000
+
+
+class LRUCacheBackend:
+    """ In-process LRU кэш (по умолчанию)
+
+    Живет в памяти одного процесса. При нескольких воркерах gunicorn
+    сигналы сбрасывают кэш только в том процессе, где прошла запись,
+    поэтому остальные процессы отдают данные не старше timeout.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 timeout=DEFAULT_TIMEOUT):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.timeout is not None:
+            expires = time.monotonic() + self.timeout
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_version(self, key):
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def incr_version(self, key):
+        """ Счетчики версий живут отдельно: без timeout и вытеснения"""
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+
+class DjangoCacheBackend:
+    """ Адаптер к кэшу из settings.CACHES (общий для всех процессов)"""
+
+    def __init__(self, alias='default', timeout=DEFAULT_TIMEOUT):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+    def get_version(self, key):
+        version = self.cache.get(key)
+        if version is None:
+            self.cache.add(key, initial_version(), None)
+            version = self.cache.get(key) or initial_version()
+        return version
+
+    def incr_version(self, key):
+        """ Атомарный incr, версия хранится без timeout"""
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Ключа нет: новый или вытеснен кэшем
+            self.cache.add(key, initial_version(), None)
+            return self.cache.incr(key)
+
+
+class RecipeResponseCache:
+    """ Кэш сериализованных ответов рецептов для анонимов
+
+    Ключ списка строится из нормализованной строки запроса, ключ
+    рецепта - из его id. Списки сбрасываются сменой версии, так что
+    бэкенду не нужно уметь удалять по префиксу.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_query(request):
+        """ Параметры запроса в стабильном порядке"""
+        params = request.query_params
+        return '&'.join(
+            f'{key}={value}'
+            for key in sorted(params)
+            for value in sorted(params.getlist(key))
+        )
+
+    def _version(self, name):
+        return self.backend.get_version(f'{KEY_PREFIX}:{name}:version')
+
+    def _bump(self, name):
+        self.backend.incr_version(f'{KEY_PREFIX}:{name}:version')
+
+    def list_key(self, request):
+        return '{p}:{g}:list:{v}:{host}?{query}'.format(
+            p=KEY_PREFIX,
+            g=self._version('global'),
+            v=self._version('list'),
+            host=request.get_host(),
+            query=self.normalize_query(request),
+        )
+
+    def detail_key(self, pk):
+        return '{p}:{g}:detail:{pk}'.format(
+            p=KEY_PREFIX, g=self._version('global'), pk=pk
+        )
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate_recipe(self, pk):
+        """ Сброс одного рецепта и всех списков"""
+        self.backend.delete(self.detail_key(pk))
+        self._bump('list')
+
+    def invalidate_all(self):
+        """ Сброс всего кэша (теги, ингредиенты, авторы)"""
+        self._bump('global')
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def build_response_cache():
+    config = getattr(settings, 'RECIPE_RESPONSE_CACHE', {})
+    backend_class = import_string(config.get('BACKEND', DEFAULT_BACKEND))
+    return RecipeResponseCache(backend_class(**config.get('OPTIONS', {})))
+
+
+response_cache = build_response_cache()
+
+
+class AnonymousResponseCacheMixin:
+    """ Class mixin to serve list/retrieve from cache for anonymous users"""
+    cache_header = 'X-Cache'
+
+    def cached_response(self, request, key, render):
+        if request.user.is_authenticated:
+            return render()
+
+        data = response_cache.get(key)
+        if data is not None:
+            response = Response(data)
+            response[self.cache_header] = 'HIT'
+            return response
+
+        response = render()
+        if response.status_code == 200:
+            response_cache.set(key, response.data)
+        response[self.cache_header] = 'MISS'
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            request,
+            response_cache.list_key(request),
+            lambda: super(AnonymousResponseCacheMixin, self).list(
+                request, *args, **kwargs
+            )
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = str(kwargs.get(self.lookup_url_kwarg or self.lookup_field))
+        if not lookup.isdigit():
+            return super().retrieve(request, *args, **kwargs)
+        return self.cached_response(
+            request,
+            response_cache.detail_key(int(lookup)),
+            lambda: super(AnonymousResponseCacheMixin, self).retrieve(
+                request, *args, **kwargs
+            )
+        )
+
+
+class ReferenceBytesCacheMixin:
+    """ Class mixin to serve unfiltered reference lists from ready JSON bytes
+
+    Байты полного списка хранятся в памяти процесса вместе с версией
+    таблицы (TableVersion), по которой их собрали. Версию повышают
+    сигналы модели, после этого байты собираются заново.
+    """
+    version_table = None
+    max_age = REFERENCE_MAX_AGE
+    _rendered = {}
+
+    def is_full_list(self, request):
+        return self.action == 'list' and not request.query_params
+
+    def get_table_version(self):
+        return TableVersion.objects.filter(
+            table=self.version_table
+        ).values_list('version', flat=True).first() or 0
+
+    def list(self, request, *args, **kwargs):
+        renderer = request.accepted_renderer
+        if not self.is_full_list(request) or renderer.format != 'json':
+            return super().list(request, *args, **kwargs)
+
+        version = self.get_table_version()
+        cached = self._rendered.get(self.version_table)
+        if cached is None or cached[0] != version:
+            data = super().list(request, *args, **kwargs).data
+            cached = (version, renderer.render(data))
+            self._rendered[self.version_table] = cached
+        return HttpResponse(cached[1], content_type=renderer.media_type)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(
+            request, response, *args, **kwargs
+        )
+        if self.is_full_list(request) and response.status_code in (200, 304):
+            patch_cache_control(response, public=True, max_age=self.max_age)
+        return response
@@ -0,0 +1,108 @@
+import hashlib
+
+from django.db.models import Exists, OuterRef
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+
+from .filters import RecipeCustomFilter
+from recipes.models import Recipe, TableVersion
+from users.models import Follow
+
+RECIPE_REFERENCE_TABLES = ('tag', 'ingredient')
+
+
+def get_table_versions(*tables):
+    """ Версии и даты изменения таблиц одним запросом"""
+    versions = {
+        row['table']: (row['version'], row['updated_at'])
+        for row in TableVersion.objects.filter(table__in=tables).values(
+            'table', 'version', 'updated_at'
+        )
+    }
+    return [versions.get(table, (0, None)) for table in tables]
+
+
+def query_hash(request):
+    """ Короткий хэш строки запроса для ключа коллекции"""
+    return hashlib.md5(
+        request.META.get('QUERY_STRING', '').encode()
+    ).hexdigest()[:12]
+
+
+def table_etag(table):
+    """ ETag коллекции: версия таблицы + параметры запроса"""
+    def etag_func(request, *args, **kwargs):
+        [(version, _)] = get_table_versions(table)
+        return f'{table}-{version}-{query_hash(request)}'
+    return etag_func
+
+
+def table_last_modified(table):
+    def last_modified_func(request, *args, **kwargs):
+        [(_, updated_at)] = get_table_versions(table)
+        return updated_at
+    return last_modified_func
+
+
+def get_recipe_state(request, pk):
+    """ Дата изменения рецепта и флаги текущего юзера одним запросом"""
+    user = request.user
+    queryset = RecipeCustomFilter().annotate_user_flags(
+        Recipe.objects.filter(pk=pk), user
+    )
+    fields = [
+        'updated_at', 'favorites_count',
+        'is_favorited', 'is_in_shopping_cart'
+    ]
+    if user.is_authenticated:
+        queryset = queryset.annotate(is_subscribed=Exists(
+            Follow.objects.filter(user=user, following=OuterRef('author'))
+        ))
+        fields.append('is_subscribed')
+    return queryset.values_list(*fields).first()
+
+
+def recipe_etag(request, pk, *args, **kwargs):
+    """ ETag рецепта: версия рецепта, справочников и флаги юзера"""
+    if not str(pk).isdigit():
+        return None
+    state = get_recipe_state(request, pk)
+    if state is None:
+        return None
+    updated_at, favorites_count, *flags = state
+    tables = get_table_versions(*RECIPE_REFERENCE_TABLES)
+    return 'recipe-{pk}-{ts}-{count}-{tables}-{flags}-{query}'.format(
+        pk=pk,
+        ts=updated_at.timestamp(),
+        count=favorites_count,
+        tables='.'.join(str(version) for version, _ in tables),
+        flags=''.join(str(int(flag)) for flag in flags),
+        query=query_hash(request),
+    )
+
+
+def recipe_last_modified(request, pk, *args, **kwargs):
+    """ Last-Modified рецепта, только для анонимов
+
+    У авторизованного юзера ответ зависит от избранного и подписок,
+    которые дата рецепта не отражает - для него достаточно ETag.
+    """
+    if request.user.is_authenticated or not str(pk).isdigit():
+        return None
+    updated_at = Recipe.objects.filter(pk=pk).values_list(
+        'updated_at', flat=True
+    ).first()
+    if updated_at is None:
+        return None
+    dates = [updated_at] + [
+        date for _, date in get_table_versions(*RECIPE_REFERENCE_TABLES)
+        if date is not None
+    ]
+    return max(dates)
+
+
+def conditional_method(etag_func, last_modified_func):
+    """ Декоратор метода viewset: 304 до сериализации"""
+    return method_decorator(
+        condition(etag_func=etag_func, last_modified_func=last_modified_func)
+    )
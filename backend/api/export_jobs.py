@@ -0,0 +1,113 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db.models import Q
+from django.utils import timezone
+
+from .helpers import ShoppingListDownloadHelper
+from .renderers import SHOPPING_LIST_RENDERERS
+from recipes.models import ExportJob
+
+# Задачи, которые воркер разбирает за один проход по очереди
+CLAIM_BATCH_SIZE = 10
+POLL_INTERVAL = 1
+# Задача "зависла", если воркер не закончил ее за это время
+STALE_AFTER = timedelta(minutes=10)
+# Как часто воркер удаляет старые выгрузки
+PURGE_INTERVAL = 10 * 60
+
+
+def default_retention():
+    return timedelta(hours=settings.EXPORT_RETENTION_HOURS)
+
+
+def claimable(stale_after=STALE_AFTER):
+    """ Задачи в очереди и зависшие у упавших воркеров"""
+    return Q(status=ExportJob.PENDING) | Q(
+        status=ExportJob.RUNNING,
+        started_at__lt=timezone.now() - stale_after
+    )
+
+
+def claim_next_job(stale_after=STALE_AFTER):
+    """ Взять следующую задачу из очереди
+
+    Захват - условный UPDATE: из нескольких воркеров строку
+    обновит только один, блокировки и брокер не нужны.
+    """
+    candidates = ExportJob.objects.filter(
+        claimable(stale_after)
+    ).order_by('created_at').values_list('pk', flat=True)
+    for pk in candidates[:CLAIM_BATCH_SIZE]:
+        claimed = ExportJob.objects.filter(
+            claimable(stale_after), pk=pk
+        ).update(status=ExportJob.RUNNING, started_at=timezone.now())
+        if claimed:
+            return ExportJob.objects.select_related('user').get(pk=pk)
+    return None
+
+
+def run_job(job):
+    """ Отрендерить файл задачи в хранилище (settings.EXPORT_ROOT)"""
+    try:
+        renderer = SHOPPING_LIST_RENDERERS[job.file_format]()
+        recipes, positions = ShoppingListDownloadHelper().get_shopping_list(
+            job.user
+        )
+        # HttpResponse и StreamingHttpResponse отдают файл кусками
+        content = b''.join(renderer.export(recipes, positions))
+        job.file.save(
+            f'{job.pk}.{renderer.format}',
+            ContentFile(content),
+            save=False
+        )
+        job.status = ExportJob.DONE
+    except Exception as exc:
+        job.status = ExportJob.FAILED
+        job.error = f'{type(exc).__name__}: {exc}'
+    job.finished_at = timezone.now()
+    job.save(update_fields=['file', 'status', 'error', 'finished_at'])
+    return job
+
+
+def purge_expired(retention=None):
+    """ Удалить задачи, завершенные раньше retention назад, и их файлы
+
+    Возвращает кол-во удаленных задач.
+    """
+    cutoff = timezone.now() - (retention or default_retention())
+    expired = ExportJob.objects.filter(finished_at__lt=cutoff)
+    purged = 0
+    for job in expired.iterator():
+        if job.file:
+            job.file.delete(save=False)
+        job.delete()
+        purged += 1
+    return purged
+
+
+def work(poll_interval=POLL_INTERVAL, stale_after=STALE_AFTER, once=False,
+         log=None, retention=None):
+    """ Цикл воркера, с once=True - выход при пустой очереди"""
+    processed = 0
+    purged_at = None
+    while True:
+        if purged_at is None or (
+            time.monotonic() - purged_at >= PURGE_INTERVAL
+        ):
+            purged = purge_expired(retention)
+            purged_at = time.monotonic()
+            if purged and log is not None:
+                log(f'Удалено старых выгрузок: {purged}')
+        job = claim_next_job(stale_after)
+        if job is None:
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        processed += 1
+        if log is not None:
+            log(f'Выгрузка {job.pk} ({job.file_format}): {job.status}')
@@ -1,25 +1,98 @@
 import django_filters
-from django.db.models import Q
+from django.db.models import BooleanField, Exists, OuterRef, Value
 from rest_framework import filters
 
-from recipes.models import Recipe
+from .ingredient_index import ingredient_index
+from recipes.models import Favorite, Recipe, ShoppingList
+from recipes.search import search_recipes
 
 
 class RecipeViewSetFilter(django_filters.FilterSet):
     """ Класс для Фильтрации по Тегам на страницах"""
+    TAGS_MODE_ANY = 'any'
+    TAGS_MODE_ALL = 'all'
+    USER_RELATION_MODELS = {
+        'is_favorited': Favorite,
+        'is_in_shopping_cart': ShoppingList,
+    }
 
     tags = django_filters.CharFilter(
         method='filter_tags'
     )
+    tags_mode = django_filters.ChoiceFilter(
+        choices=(
+            (TAGS_MODE_ANY, 'Любой из тегов'),
+            (TAGS_MODE_ALL, 'Все теги'),
+        ),
+        method='filter_tags_mode'
+    )
+    is_favorited = django_filters.NumberFilter(
+        method='filter_user_relation'
+    )
+    is_in_shopping_cart = django_filters.NumberFilter(
+        method='filter_user_relation'
+    )
+    search = django_filters.CharFilter(
+        method='filter_search'
+    )
 
     def filter_tags(self, queryset, name, value):
-        """ Метод фильтрации по тегам в параметрах запроса"""
-        tags = self.request.GET.getlist('tags')
-        return queryset.filter(tags__slug__in=tags).distinct()
+        """ Метод фильтрации по тегам в параметрах запроса
+
+        Вместо JOIN + DISTINCT по всей строке рецепта используем
+        полусоединение EXISTS по таблице связи рецепт-тег.
+        """
+        tags = set(self.request.GET.getlist('tags'))
+        recipe_tags = Recipe.tags.through.objects.filter(
+            recipe=OuterRef('pk')
+        )
+        if self.data.get('tags_mode') == self.TAGS_MODE_ALL:
+            for slug in tags:
+                queryset = queryset.filter(
+                    Exists(recipe_tags.filter(tag__slug=slug))
+                )
+            return queryset
+        return queryset.filter(
+            Exists(recipe_tags.filter(tag__slug__in=tags))
+        )
+
+    def filter_tags_mode(self, queryset, name, value):
+        """ Режим учитывается в filter_tags"""
+        return queryset
+
+    def filter_user_relation(self, queryset, name, value):
+        """ Фильтр по избранному / списку покупок текущего юзера
+
+        1 - только отмеченные рецепты, 0 - только не отмеченные.
+        Подзапрос EXISTS выполняется в базе и сочетается с остальными
+        фильтрами. Для анонима параметр игнорируется.
+        """
+        user = self.request.user
+        if not user.is_authenticated:
+            return queryset
+        model = self.USER_RELATION_MODELS[name]
+        related = Exists(
+            model.objects.filter(user=user, recipe=OuterRef('pk'))
+        )
+        return queryset.filter(related if value else ~related)
+
+    def filter_search(self, queryset, name, value):
+        """ Полнотекстовый поиск по названию и описанию
+
+        Самые релевантные рецепты первыми, ?ordering= это переопределяет.
+        """
+        if not value.strip():
+            return queryset
+        return search_recipes(queryset, value).order_by(
+            '-search_rank', '-pub_date', '-id'
+        )
 
     class Meta:
         model = Recipe
-        fields = ['author', 'tags']
+        fields = [
+            'author', 'tags', 'tags_mode',
+            'is_favorited', 'is_in_shopping_cart', 'search'
+        ]
 
 
 class RecipeCustomFilter():
@@ -27,35 +100,47 @@ class RecipeCustomFilter():
     FAVORITE_PARAM = 'is_favorited'
     SHOPPING_CART_PARAM = 'is_in_shopping_cart'
 
-    def get_filtered_queryset(self, query_param, user):
-        """ Фильтруем queryset по переданному параметру"""
-        if query_param == self.FAVORITE_PARAM:
-            param_queryset = user.users_favorite.all()
-        elif query_param == self.SHOPPING_CART_PARAM:
-            param_queryset = user.users_shoppinglist.all()
+    def annotate_user_flags(self, queryset, user):
+        """ Вычисляем флаги избранного и списка покупок в самом запросе
 
-        param_list = [
-            param['recipe_id']
-            for param in param_queryset.values()
-        ]
-        return Recipe.objects.filter(pk__in=param_list)
+        Флаги is_favorited / is_in_shopping_cart добавляются к queryset
+        как подзапросы EXISTS, чтобы сериализатор не делал
+        по два запроса на каждый рецепт.
+        """
+        if not user.is_authenticated:
+            return queryset.annotate(**{
+                self.FAVORITE_PARAM: Value(False, BooleanField()),
+                self.SHOPPING_CART_PARAM: Value(False, BooleanField()),
+            })
+        return queryset.annotate(**{
+            self.FAVORITE_PARAM: Exists(
+                Favorite.objects.filter(user=user, recipe=OuterRef('pk'))
+            ),
+            self.SHOPPING_CART_PARAM: Exists(
+                ShoppingList.objects.filter(user=user, recipe=OuterRef('pk'))
+            ),
+        })
 
 
 class CustomSearchFilter(filters.SearchFilter):
-    """ Хелпер для поиска по ингредиентам"""
+    """ Хелпер для поиска по ингредиентам
+
+    Поиск идет по индексу в памяти (api.ingredient_index): сначала
+    ингредиенты, начинающиеся с запроса, затем содержащие его.
+    С ?fuzzy=1 - поиск с опечатками по триграммам.
+    """
     search_param = "name"
+    fuzzy_param = "fuzzy"
 
     def filter_queryset(self, request, queryset, view):
-        search_param = request.query_params.get(
-            self.search_param, ''
-        ).lower()
-
-        startswith_results = queryset.filter(
-            name__istartswith=search_param
-        )
-        contains_results = queryset.filter(
-            ~Q(name__istartswith=search_param),
-            name__icontains=search_param
-        )
+        """ Для списка - найденные ингредиенты по рангу (список)
 
-        return startswith_results | contains_results
+        Остальные действия получают queryset как есть: get_object()
+        ищет объект в нем, а не в результатах поиска.
+        """
+        search_param = request.query_params.get(self.search_param, '')
+        if not search_param or getattr(view, 'action', None) != 'list':
+            return queryset
+        if request.query_params.get(self.fuzzy_param) in ('1', 'true'):
+            return ingredient_index.fuzzy_search(search_param)
+        return ingredient_index.search(search_param)
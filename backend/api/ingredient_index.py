@@ -0,0 +1,175 @@
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+from recipes.models import Ingredient, TableVersion
+
+INGREDIENT_TABLE = 'ingredient'
+PREFIX_END = '\U0010ffff'
+# Доля триграмм запроса, которые должны найтись в имени ингредиента
+FUZZY_THRESHOLD = 0.5
+FUZZY_LIMIT = 50
+FUZZY_MIN_LENGTH = 3
+WORD_RE = re.compile(r'\w+')
+
+
+def trigrams(text):
+    """ Триграммы как в pg_trgm: слова с двумя пробелами слева и
+    одним справа
+    """
+    result = set()
+    for word in WORD_RE.findall(text.casefold()):
+        padded = f'  {word} '
+        result.update(
+            padded[i:i + 3] for i in range(len(padded) - 2)
+        )
+    return result
+
+
+class TrigramIndex:
+    """ Инвертированный индекс триграмм: триграмма -> номера имен"""
+
+    def __init__(self, keys):
+        self.sizes = array('I')
+        postings = defaultdict(lambda: array('I'))
+        for position, key in enumerate(keys):
+            key_trigrams = trigrams(key)
+            self.sizes.append(len(key_trigrams))
+            for trigram in key_trigrams:
+                postings[trigram].append(position)
+        self.postings = dict(postings)
+        # Множества для частых триграмм, собираются по требованию
+        self.posting_sets = {}
+
+    def posting_set(self, trigram):
+        result = self.posting_sets.get(trigram)
+        if result is None:
+            result = frozenset(self.postings.get(trigram, ()))
+            self.posting_sets[trigram] = result
+        return result
+
+    def search(self, query, limit=FUZZY_LIMIT):
+        """ Номера самых похожих на запрос имен, лучшие первыми
+
+        Кандидатов дают самые редкие триграммы запроса: имя с долей
+        совпадений не ниже порога есть хотя бы в одном из них.
+        Частые триграммы только проверяются у кандидатов. Ранжируем
+        по числу общих триграмм, затем по сходству всего имени
+        (при равном числе общих выше то, где меньше лишних триграмм).
+        """
+        query_trigrams = sorted(
+            trigrams(query), key=lambda tri: len(self.postings.get(tri, ()))
+        )
+        total = len(query_trigrams)
+        if not total:
+            return []
+        required = math.ceil(FUZZY_THRESHOLD * total)
+
+        shared = Counter()
+        for trigram in query_trigrams[:total - required + 1]:
+            shared.update(self.postings.get(trigram, ()))
+        for trigram in query_trigrams[total - required + 1:]:
+            shared.update(self.posting_set(trigram).intersection(shared))
+
+        ranked = []
+        boundary = None
+        for position, count in shared.most_common():
+            if count < required or (boundary and count < boundary):
+                break
+            ranked.append((-count, self.sizes[position], position))
+            if len(ranked) == limit:
+                boundary = count
+        ranked.sort()
+        return [position for _, _, position in ranked[:limit]]
+
+
+class IngredientIndex:
+    """ Индекс ингредиентов в памяти процесса для автодополнения
+
+    Хранит отсортированный массив имен в casefold. Префикс ищется
+    бинарным поиском, подстрока - перебором. Индекс строится при
+    первом запросе и перестраивается, когда меняется версия таблицы
+    ингредиентов (TableVersion, см. api.signals).
+
+    Для нечеткого поиска по тем же именам лениво строится TrigramIndex.
+    """
+
+    def __init__(self):
+        self.version = None
+        # (ключи, ингредиенты, индекс триграмм) - меняем одной ссылкой
+        self.data = ([], [], None)
+        self._lock = threading.Lock()
+
+    def build(self, version):
+        rows = sorted(
+            (
+                (name.casefold(), name, pk, unit)
+                for pk, name, unit in Ingredient.objects.values_list(
+                    'id', 'name', 'measurement_unit'
+                )
+            ),
+            key=lambda row: (row[0], row[2])
+        )
+        self.data = (
+            [row[0] for row in rows],
+            [
+                Ingredient(id=pk, name=name, measurement_unit=unit)
+                for _, name, pk, unit in rows
+            ],
+            None
+        )
+        self.version = version
+
+    def refresh(self):
+        """ Перестроить индекс, если таблица изменилась"""
+        version = TableVersion.objects.filter(
+            table=INGREDIENT_TABLE
+        ).values_list('version', flat=True).first() or 0
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.build(version)
+
+    def search(self, query):
+        """ Сначала совпадения по началу имени, затем по подстроке"""
+        self.refresh()
+        query = query.casefold()
+        keys, items, _ = self.data
+
+        start = bisect_left(keys, query)
+        end = bisect_left(keys, query + PREFIX_END, start)
+
+        prefix = items[start:end]
+        contains = [
+            item for key, item in zip(keys, items)
+            if query in key and not key.startswith(query)
+        ]
+        return prefix + contains
+
+    def get_trigram_index(self):
+        keys, items, trigram_index = self.data
+        if trigram_index is None:
+            with self._lock:
+                keys, items, trigram_index = self.data
+                if trigram_index is None:
+                    trigram_index = TrigramIndex(keys)
+                    self.data = (keys, items, trigram_index)
+        return items, trigram_index
+
+    def fuzzy_search(self, query):
+        """ Поиск с опечатками по сходству триграмм
+
+        Для запросов короче триграммы нечеткий поиск бессмыслен,
+        отдаем обычный поиск по префиксу.
+        """
+        if len(query.strip()) < FUZZY_MIN_LENGTH:
+            return self.search(query)
+        self.refresh()
+        items, trigram_index = self.get_trigram_index()
+        return [items[position] for position in trigram_index.search(query)]
+
+
+ingredient_index = IngredientIndex()
@@ -0,0 +1,70 @@
+import multiprocessing
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.export_jobs import POLL_INTERVAL, STALE_AFTER, work
+
+
+class Command(BaseCommand):
+    help = (
+        'Воркер фоновых выгрузок списка покупок: берет задачи ExportJob '
+        'из базы, рендерит файлы в EXPORT_ROOT и удаляет старые'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=1,
+            help='Кол-во процессов воркера',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Разобрать очередь и выйти',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=POLL_INTERVAL,
+            help='Пауза (с) между проверками пустой очереди',
+        )
+        parser.add_argument(
+            '--stale-after',
+            type=int,
+            default=int(STALE_AFTER.total_seconds()),
+            help='Через сколько секунд задачу упавшего воркера взять снова',
+        )
+        parser.add_argument(
+            '--retention-hours',
+            type=float,
+            default=settings.EXPORT_RETENTION_HOURS,
+            help='Через сколько часов удалять готовые выгрузки',
+        )
+
+    def handle(self, *args, **options):
+        params = {
+            'poll_interval': options['poll_interval'],
+            'stale_after': timedelta(seconds=options['stale_after']),
+            'once': options['once'],
+            'log': self.stdout.write,
+            'retention': timedelta(hours=options['retention_hours']),
+        }
+        if options['workers'] <= 1:
+            work(**params)
+            return
+
+        # Соединение с базой не должно переходить в дочерние процессы
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=work, kwargs=params)
+            for _ in range(options['workers'])
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
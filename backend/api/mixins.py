@@ -1,15 +1,31 @@
 from typing import Optional
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import (Count, Exists, F, OuterRef, Prefetch, Window,
+                              prefetch_related_objects)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import RowNumber
 from django.http import HttpRequest
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import serializers, status
 from rest_framework.response import Response
 
+from .cache import response_cache
 from .exception import ObjectNotFound
-from recipes.models import Recipe, RecipeIngredient
-from users.models import User
+from recipes.models import (Favorite, Recipe, RecipeIngredient, ShoppingList,
+                            Tag)
+from recipes.shopping import refresh_cart_recipe
+from users.models import Follow, User
+
+# Счетчики в Recipe для связанных с юзером моделей
+RECIPE_COUNTERS = {
+    Favorite: 'favorites_count',
+    ShoppingList: 'shopping_count',
+}
+# Счетчики, которые отдаются в ответе рецепта
+PUBLIC_RECIPE_COUNTERS = {'favorites_count'}
 
 
 class UserRelatedModelMixin:
@@ -23,6 +39,29 @@ class UserRelatedModelMixin:
             raise ObjectNotFound
         return obj
 
+    def update_recipe_counter(self, rel_model, recipe_id, delta):
+        """ Атомарно изменить счетчик рецепта через F()
+
+        Видимый в ответе счетчик меняет и сам рецепт: updated_at
+        (Last-Modified) и кэш ответов для анонимов.
+        """
+        field = RECIPE_COUNTERS.get(rel_model)
+        if field is None:
+            return
+        changes = {field: F(field) + delta}
+        if field in PUBLIC_RECIPE_COUNTERS:
+            changes['updated_at'] = timezone.now()
+            # После коммита, чтобы кэш не успел заполниться старым
+            transaction.on_commit(
+                lambda: response_cache.invalidate_recipe(recipe_id)
+            )
+        Recipe.objects.filter(pk=recipe_id).update(**changes)
+
+    def update_shopping_totals(self, rel_model, user, recipe_id):
+        """ Пересчитать суммы корзины юзера в той же транзакции"""
+        if rel_model is ShoppingList:
+            refresh_cart_recipe(user.pk, recipe_id)
+
     def add_model(
         self,
         par_model: models.Model,
@@ -43,7 +82,10 @@ class UserRelatedModelMixin:
         )
         try:
             serializer.is_valid(raise_exception=True)
-            serializer.save()
+            with transaction.atomic():
+                serializer.save()
+                self.update_recipe_counter(rel_model, parent_obj.pk, 1)
+                self.update_shopping_totals(rel_model, user, parent_obj.pk)
             return Response(
                 serializer.data,
                 status=status.HTTP_201_CREATED
@@ -85,10 +127,172 @@ class UserRelatedModelMixin:
                 'Not implemented parent model',
                 status=status.HTTP_400_BAD_REQUEST
             )
-        model_obj.delete()
+        with transaction.atomic():
+            model_obj.delete()
+            self.update_recipe_counter(rel_model, parent_obj.pk, -1)
+            self.update_shopping_totals(rel_model, user, parent_obj.pk)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class RecipePrefetchMixin:
+    """ Class mixin with the common prefetch plan for reading recipes
+
+    Used by list/retrieve of RecipeViewSet and by
+    RecipeCreateSerializer.to_representation, so a page of recipes
+    costs a fixed number of queries.
+    """
+
+    def prefetch_recipe_relations(self, queryset, user=None, fields=None):
+        """ Подгружаем автора, теги и ингредиенты пачкой
+
+        fields - поля ответа (см. SparseFieldsMixin), для неиспользуемых
+        связи не загружаются.
+        """
+        # Поисковый вектор в ответ не попадает
+        queryset = queryset.defer('search_vector')
+        if fields is not None:
+            if 'text' not in fields:
+                queryset = queryset.defer('text')
+            if 'author' not in fields:
+                return self.prefetch_recipe_lists(queryset, fields)
+        if user is not None and user.is_authenticated:
+            # Флаг подписки на автора считаем в том же запросе
+            author = Prefetch(
+                'author',
+                queryset=User.objects.annotate(
+                    is_subscribed=Exists(
+                        Follow.objects.filter(
+                            user=user, following=OuterRef('pk')
+                        )
+                    )
+                )
+            )
+            queryset = queryset.prefetch_related(author)
+        else:
+            queryset = queryset.select_related('author')
+        return self.prefetch_recipe_lists(queryset, fields)
+
+    def prefetch_recipe_lists(self, queryset, fields=None):
+        """ Теги и ингредиенты рецептов"""
+        if fields is None or 'tags' in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch('tags', queryset=Tag.objects.all())
+            )
+        if fields is None or 'ingredients' in fields:
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    'rel_RecipeIngredient',
+                    queryset=RecipeIngredient.objects.select_related(
+                        'ingredient'
+                    )
+                )
+            )
+        return queryset
+
+
+class SubscriptionPrefetchMixin:
+    """ Class mixin with the constant-query plan for user subscriptions
+
+    A page of followed authors costs three queries: pagination count,
+    authors with recipes_count, and recipes of all authors on the page.
+    """
+    recipes_limit_param = 'recipes_limit'
+    subscription_recipes_attr = 'subscription_recipes'
+
+    def get_recipes_limit(self):
+        """ Лимит рецептов на автора из ?recipes_limit= или None"""
+        try:
+            limit = int(self.request.query_params[self.recipes_limit_param])
+        except (KeyError, ValueError):
+            return None
+        return limit if limit > 0 else None
+
+    def subscriptions_queryset(self, user):
+        """ Авторы, на которых подписан юзер, с кол-вом рецептов"""
+        return User.objects.filter(
+            pk__in=Follow.objects.filter(user=user).values('following')
+        ).annotate(recipes_count=Count('recipes')).order_by('username')
+
+    def limit_recipes_per_author(self, queryset, limit):
+        """ Первые limit рецептов каждого автора (окно ROW_NUMBER)
+
+        Django 3.2 не умеет фильтровать по оконной функции,
+        поэтому нумерация - во вложенном запросе.
+        """
+        ranked = queryset.annotate(author_rank=Window(
+            RowNumber(),
+            partition_by=[F('author')],
+            order_by=[F('pub_date').desc(), F('pk').desc()]
+        )).order_by().values('pk', 'author_rank')
+        sql, params = ranked.query.get_compiler(ranked.db).as_sql()
+        return queryset.filter(pk__in=RawSQL(
+            f'SELECT ranked.id FROM ({sql}) ranked '
+            f'WHERE ranked.author_rank <= %s',
+            (*params, limit)
+        ))
+
+    def prefetch_author_recipes(self, authors, limit=None):
+        """ Рецепты авторов страницы одним запросом"""
+        recipes = Recipe.objects.filter(author__in=authors).only(
+            'id', 'author', 'name', 'image', 'cooking_time', 'pub_date'
+        ).order_by('-pub_date', '-pk')
+        if limit is not None:
+            recipes = self.limit_recipes_per_author(recipes, limit)
+        prefetch_related_objects(authors, Prefetch(
+            'recipes',
+            queryset=recipes,
+            to_attr=self.subscription_recipes_attr
+        ))
+        return authors
+
+
+def select_fields(field_names, sparse_fields=None):
+    """ Отбор полей ответа по параметрам ?fields= / ?omit="""
+    include, omit = sparse_fields or (None, set())
+    return [
+        name for name in field_names
+        if (include is None or name in include) and name not in omit
+    ]
+
+
+class SparseFieldsMixin:
+    """ Class mixin to pass ?fields= / ?omit= to serializer context"""
+    fields_param = 'fields'
+    omit_param = 'omit'
+
+    def parse_fields_param(self, param):
+        return {
+            name.strip()
+            for value in self.request.query_params.getlist(param)
+            for name in value.split(',')
+            if name.strip()
+        }
+
+    def get_sparse_fields(self):
+        """ Пара (поля для вывода или None, поля для исключения)"""
+        return (
+            self.parse_fields_param(self.fields_param) or None,
+            self.parse_fields_param(self.omit_param)
+        )
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['sparse_fields'] = self.get_sparse_fields()
+        return context
+
+
+class SparseFieldsSerializerMixin:
+    """ Class mixin to drop serializer fields not requested by client"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        sparse_fields = self.context.get('sparse_fields')
+        if sparse_fields:
+            allowed = set(select_fields(self.fields, sparse_fields))
+            for name in set(self.fields) - allowed:
+                self.fields.pop(name)
+
+
 class RecipeRelationMixin:
     """ Class mixin to create new relations
     between Recipe and Tags and Ingredients
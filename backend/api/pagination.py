@@ -1,5 +1,12 @@
+from collections import OrderedDict
+
 from django.conf import settings
-from rest_framework.pagination import PageNumberPagination
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import (Cursor, CursorPagination,
+                                       PageNumberPagination)
+from rest_framework.response import Response
 
 
 class CustomPageNumberPagination(PageNumberPagination):
@@ -7,3 +14,140 @@ class CustomPageNumberPagination(PageNumberPagination):
 
     page_size_query_param = 'limit'
     max_page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+
+
+class RecipeCursorPagination(CursorPagination):
+    """ Keyset пагинация рецептов по (pub_date, id) без COUNT(*)"""
+
+    ordering = ('-pub_date', '-id')
+    # Позиция курсора строится по первому полю порядка. Годится только
+    # неизменное поле с редкими повторами, иначе страницы уходят в OFFSET
+    cursor_ordering_fields = ('pub_date',)
+    page_size_query_param = 'limit'
+    max_page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+
+    @staticmethod
+    def requested_ordering(request, queryset, view):
+        """ Порядок из ?ordering= через OrderingFilter вьюхи или None
+
+        OrderingFilter вьюхи без параметра возвращает None, а порядок
+        по умолчанию ему не задан: иначе он перебил бы сортировку
+        по релевантности у ?search=.
+        """
+        for backend in getattr(view, 'filter_backends', ()):
+            if issubclass(backend, OrderingFilter):
+                return backend().get_ordering(request, queryset, view)
+        return None
+
+    @classmethod
+    def supports_ordering(cls, ordering):
+        return all(
+            field.lstrip('-') in cls.cursor_ordering_fields
+            for field in ordering or ()
+        )
+
+    def get_ordering(self, request, queryset, view):
+        """ Порядок из ?ordering=, без него - (pub_date, id)"""
+        ordering = self.requested_ordering(request, queryset, view)
+        if not ordering:
+            return self.ordering
+        direction = '-' if ordering[0].startswith('-') else ''
+        return (ordering[0], f'{direction}id')
+
+
+class RecipePagination(CustomPageNumberPagination):
+    """ Пагинация рецептов: page/limit по умолчанию,
+    курсорная при ?pagination=cursor или переданном cursor
+
+    Курсор работает только с порядком по pub_date, с другим ?ordering=
+    остается page/limit.
+    """
+
+    mode_query_param = 'pagination'
+    cursor_mode = 'cursor'
+
+    def __init__(self):
+        self.cursor_paginator = None
+
+    def use_cursor(self, request):
+        """ Включен ли курсорный режим для запроса"""
+        cursor_query_param = RecipeCursorPagination.cursor_query_param
+        return (
+            request.query_params.get(self.mode_query_param)
+            == self.cursor_mode
+            or cursor_query_param in request.query_params
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        ordering = RecipeCursorPagination.requested_ordering(
+            request, queryset, view
+        )
+        if self.use_cursor(request) and (
+            RecipeCursorPagination.supports_ordering(ordering)
+        ):
+            self.cursor_paginator = RecipeCursorPagination()
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view
+            )
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
+
+
+class FeedCursorPagination(CursorPagination):
+    """ Курсор ленты подписок: позиция (pub_date, id) последнего рецепта
+
+    Лента собирается из двух источников (см. recipes.timeline),
+    поэтому страница читается функцией, а не из queryset.
+    Только вперед: ссылка next.
+    """
+
+    page_size_query_param = 'limit'
+    max_page_size = settings.REST_FRAMEWORK['PAGE_SIZE']
+
+    def decode_position(self, request):
+        cursor = self.decode_cursor(request)
+        if cursor is None:
+            return None
+        pub_date, _, pk = (cursor.position or '').rpartition('|')
+        try:
+            position = (parse_datetime(pub_date), int(pk))
+        except ValueError:
+            position = (None, None)
+        if None in position:
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def paginate_feed(self, read_page, request):
+        """ id рецептов страницы, read_page(limit, position) - источник"""
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        positions = read_page(
+            self.page_size + 1, self.decode_position(request)
+        )
+        self.has_next = len(positions) > self.page_size
+        self.page = positions[:self.page_size]
+        return [pk for _, pk in self.page]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        pub_date, pk = self.page[-1]
+        return self.encode_cursor(Cursor(
+            offset=0, reverse=False, position=f'{pub_date.isoformat()}|{pk}'
+        ))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
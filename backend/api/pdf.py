@@ -0,0 +1,101 @@
+import hashlib
+import io
+from functools import lru_cache
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from .cache import LRUCacheBackend
+
+FONT_NAME = 'Arial'
+FONT_PATH = settings.BASE_DIR / 'static' / 'fonts' / 'Arial.ttf'
+FONT_SIZE = 12
+X_POS = 100
+X_END_POS = 300
+Y_POS = 800
+BOTTOM_MARGIN = 50
+SM_INDENT_STEP = 10
+MD_INDENT_STEP = 20
+DEVIDER_INDENT_STEP = 30
+PDF_CACHE_MAX_ENTRIES = 128
+PDF_CACHE_TIMEOUT = 60 * 10
+
+
+@lru_cache(maxsize=None)
+def register_font(name, path):
+    """ Регистрация TTF шрифта один раз на процесс
+
+    Разбор .ttf файла дорогой, повторные вызовы берут шрифт из кэша.
+    """
+    pdfmetrics.registerFont(TTFont(name, str(path)))
+    return name
+
+
+class PDFDocument:
+    """ Построчная запись текста в PDF с переносом на новую страницу"""
+
+    def __init__(self, font_name=FONT_NAME, font_path=FONT_PATH,
+                 font_size=FONT_SIZE):
+        self.buffer = io.BytesIO()
+        self.canvas = canvas.Canvas(self.buffer, pagesize=A4)
+        self.font_name = register_font(font_name, font_path)
+        self.font_size = font_size
+        self.start_page()
+
+    def start_page(self):
+        self.canvas.setFont(self.font_name, self.font_size)
+        self.y = Y_POS
+
+    def ensure_space(self, height):
+        """ Новая страница, если до нижнего поля не хватает места"""
+        if self.y - height < BOTTOM_MARGIN:
+            self.canvas.showPage()
+            self.start_page()
+
+    def line(self, text):
+        self.ensure_space(0)
+        self.canvas.drawString(X_POS, self.y, text)
+        self.y -= MD_INDENT_STEP
+
+    def divider(self):
+        self.ensure_space(SM_INDENT_STEP + DEVIDER_INDENT_STEP)
+        self.y -= SM_INDENT_STEP
+        self.canvas.line(X_POS, self.y, X_END_POS, self.y)
+        self.y -= DEVIDER_INDENT_STEP
+
+    def get_bytes(self):
+        self.canvas.showPage()
+        self.canvas.save()
+        return self.buffer.getvalue()
+
+
+class PDFCache:
+    """ Готовые PDF по хэшу содержимого (в памяти процесса)"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def make_key(*sections):
+        digest = hashlib.sha256()
+        for lines in sections:
+            for line in lines:
+                digest.update(line.encode())
+                digest.update(b'\n')
+            digest.update(b'\0')
+        return f'pdf:{digest.hexdigest()}'
+
+    def get_or_render(self, key, render):
+        content = self.backend.get(key)
+        if content is None:
+            content = render()
+            self.backend.set(key, content)
+        return content
+
+
+pdf_cache = PDFCache(LRUCacheBackend(
+    max_entries=PDF_CACHE_MAX_ENTRIES, timeout=PDF_CACHE_TIMEOUT
+))
@@ -0,0 +1,209 @@
+import csv
+import io
+
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .pdf import PDFDocument, pdf_cache
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Размер куска потокового ответа
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class FastJSONRenderer(JSONRenderer):
+    """ JSON рендер на orjson, без него - стандартный JSONRenderer
+
+    Вывод совпадает с JSONRenderer: компактные разделители, кириллица
+    без экранирования, даты и Decimal через encoder_class DRF.
+    Отступы (browsable API, indent=) рендерит stdlib.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        ret = orjson.dumps(
+            data,
+            default=self.encoder_class().default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        )
+        # Как и JSONRenderer, экранируем U+2028 и U+2029
+        return ret.replace(
+            b'\xe2\x80\xa8', b'\\u2028'
+        ).replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class ShoppingListRenderer(BaseRenderer):
+    """ Базовый рендер выгрузки списка покупок
+
+    Формат выбирает content negotiation DRF (?format= или Accept),
+    а файл строит export() - так текстовые форматы отдаются потоком.
+    Каждый рендер из SHOPPING_LIST_RENDERERS задает
+    export(recipes, positions) -> HTTP ответ с файлом: recipes - названия
+    рецептов, positions - пары (ингредиент, суммарное кол-во), оба
+    итерируются один раз.
+    """
+    filename = 'shopping_list'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        """ Сюда попадают только ошибки (401, 405), отдаем их в JSON"""
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = FastJSONRenderer.media_type
+        return FastJSONRenderer().render(data)
+
+    def attachment(self, response):
+        response['Content-Disposition'] = 'attachment; filename="{0}"'.format(
+            f'{self.filename}.{self.format}'
+        )
+        return response
+
+
+class TextShoppingListRenderer(ShoppingListRenderer):
+    """ Список покупок простым текстом, по строке на рецепт и продукт"""
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+    bom = ''
+    blank_line = ''
+
+    def get_row_writer(self, buffer):
+        return lambda text: buffer.write(f'{text}\n')
+
+    def iter_content(self, recipes, positions):
+        """ Куски файла по мере чтения строк из базы
+
+        Заголовок отдается сразу, до запросов к базе.
+        """
+        buffer = io.StringIO()
+        write_row = self.get_row_writer(buffer)
+
+        def flush():
+            chunk = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return chunk
+
+        buffer.write(self.bom)
+        write_row('Список рецептов:')
+        yield flush()
+        for name in recipes:
+            write_row(f'# {name}')
+            if buffer.tell() >= STREAM_CHUNK_SIZE:
+                yield flush()
+        write_row(self.blank_line)
+        write_row('ИТОГО Список покупок:')
+        for pos, amount in positions:
+            write_row(f'{pos} --- {amount}')
+            if buffer.tell() >= STREAM_CHUNK_SIZE:
+                yield flush()
+        yield flush()
+
+    def get_content_type(self):
+        return f'{self.media_type}; charset={self.charset}'
+
+    def export(self, recipes, positions):
+        return self.attachment(StreamingHttpResponse(
+            self.iter_content(recipes, positions),
+            content_type=self.get_content_type()
+        ))
+
+
+class CSVShoppingListRenderer(TextShoppingListRenderer):
+    """ .csv файл в UTF-8 с BOM для корректного отображения в Excel"""
+    media_type = 'text/csv'
+    format = 'csv'
+    bom = '\ufeff'
+    blank_line = ' '
+
+    def get_row_writer(self, buffer):
+        writer = csv.writer(buffer)
+        return lambda text: writer.writerow([text])
+
+    def get_content_type(self):
+        return self.media_type
+
+
+class PDFShoppingListRenderer(ShoppingListRenderer):
+    """ .pdf файл, одинаковая корзина берется из кэша по хэшу строк"""
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+    render_style = 'binary'
+    filename = 'shopping_cart'
+
+    def render_pdf(self, recipes, positions):
+        document = PDFDocument()
+        document.line('Список рецептов:')
+        for recipe in recipes:
+            document.line(recipe)
+        document.divider()
+        document.line('Список продуктов:')
+        for position in positions:
+            document.line(position)
+        return document.get_bytes()
+
+    def export(self, recipes, positions):
+        recipes = [f'# {name}' for name in recipes]
+        positions = [f'{pos} --- {amount}' for pos, amount in positions]
+        content = pdf_cache.get_or_render(
+            pdf_cache.make_key(recipes, positions),
+            lambda: self.render_pdf(recipes, positions)
+        )
+        return self.attachment(
+            HttpResponse(content, content_type=self.media_type)
+        )
+
+
+class JSONShoppingListRenderer(ShoppingListRenderer):
+    """ Список покупок в JSON для клиентов API, без вложения"""
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def export(self, recipes, positions):
+        data = {
+            'recipes': list(recipes),
+            'ingredients': [
+                {
+                    'name': pos.name,
+                    'measurement_unit': pos.measurement_unit,
+                    'amount': amount,
+                }
+                for pos, amount in positions
+            ],
+        }
+        return HttpResponse(
+            FastJSONRenderer().render(data), content_type=self.media_type
+        )
+
+
+SHOPPING_LIST_RENDERERS = {
+    renderer.format: renderer
+    for renderer in (
+        PDFShoppingListRenderer,
+        CSVShoppingListRenderer,
+        TextShoppingListRenderer,
+        JSONShoppingListRenderer,
+    )
+}
+
+
+def get_shopping_list_renderers(default_format):
+    """ Рендеры выгрузки, формат по умолчанию первым
+
+    Его DRF выбирает, когда клиент не указал ни ?format=, ни Accept.
+    """
+    return sorted(
+        SHOPPING_LIST_RENDERERS.values(),
+        key=lambda renderer: renderer.format != default_format
+    )
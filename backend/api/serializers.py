@@ -1,16 +1,23 @@
 import base64
 
 import webcolors
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.db import transaction
+from django.urls import reverse
 from djoser.serializers import SetPasswordSerializer
 from djoser.serializers import UserCreateSerializer as DjUserCreateSerializer
 from djoser.serializers import UserSerializer as DjUserSerializer
 from rest_framework import serializers
 from rest_framework.utils import model_meta
 
-from .mixins import RecipeCreateValidationMixin, RecipeRelationMixin
-from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredient,
-                            ShoppingList, Tag)
+from .mixins import (RecipeCreateValidationMixin, RecipePrefetchMixin,
+                     RecipeRelationMixin, SparseFieldsSerializerMixin,
+                     select_fields)
+from .renderers import SHOPPING_LIST_RENDERERS
+from recipes.models import (ExportJob, Favorite, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingList, Tag)
+from recipes.shopping import recipe_ingredient_ids, refresh_recipe_ingredients
 from users.models import Follow, User
 
 MIN_AMOUNT = 1
@@ -57,7 +64,7 @@ class CustomUserCreateSerializer(DjUserCreateSerializer):
         )
 
 
-class UserListSerializer(DjUserSerializer):
+class UserListSerializer(SparseFieldsSerializerMixin, DjUserSerializer):
     """ Чтение данных юзера"""
     is_subscribed = serializers.SerializerMethodField(read_only=True)
 
@@ -86,6 +93,9 @@ class UserListSerializer(DjUserSerializer):
 
         if get_subscribtions:
             return True
+        if hasattr(obj, 'is_subscribed'):
+            # Значение уже посчитано в queryset (см. RecipePrefetchMixin)
+            return obj.is_subscribed
         return (user.is_authenticated
                 and user.follower.filter(
                     following=obj
@@ -136,77 +146,116 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'amount')
 
 
-class ReadRecipeIngredientSerializer(serializers.ModelSerializer):
-    """ Рендер ингредиента в рецепт"""
-    name = serializers.CharField(
-        source='ingredient.name',
-        read_only=True
-    )
-    measurement_unit = serializers.CharField(
-        source='ingredient.measurement_unit',
-        read_only=True
-    )
-    amount = serializers.IntegerField(
-        max_value=MAX_AMOUNT,
-        min_value=MIN_AMOUNT
-    )
+class RecipeReadSerializer(serializers.BaseSerializer):
+    """ Быстрый сериализатор чтения рецептов без ModelSerializer
 
-    class Meta:
-        model = RecipeIngredient
-        fields = ('id', 'name', 'measurement_unit', 'amount')
-        read_only_fields = ('id',)
-
-
-class RecipeListSerializer(serializers.ModelSerializer):
-    """ Сериализатор для возврата списка или рецепта"""
-    tags = TagSerializer(
-        many=True,
-        read_only=True
-    )
-    author = UserListSerializer(
-        read_only=True
-    )
-    ingredients = ReadRecipeIngredientSerializer(
-        source='rel_RecipeIngredient',
-        many=True,
-    )
-    image = serializers.SerializerMethodField(
-        'get_image_url',
-        read_only=True,
+    Собирает словари вручную из объектов, загруженных через
+    RecipePrefetchMixin. Используется только для list/retrieve.
+    """
+    field_names = (
+        'id', 'tags', 'author', 'ingredients',
+        'is_favorited', 'is_in_shopping_cart',
+        'name', 'image', 'text', 'cooking_time', 'favorites_count'
     )
-    is_favorited = serializers.SerializerMethodField()
-    is_in_shopping_cart = serializers.SerializerMethodField()
-
-    class Meta:
-        model = Recipe
-        many_to_many = 'tags'
-        fields = (
-            'id', 'tags', 'author', 'ingredients',
-            'is_favorited', 'is_in_shopping_cart',
-            'name', 'image', 'text', 'cooking_time'
-        )
-        read_only_fields = ('id', 'name', 'text', 'cooking_time')
 
-    def is_model_instance_exist(self, obj, model):
-        """ Метод хелпер - находится ли в модели объект """
+    def get_user(self):
         request = self.context.get('request')
+        return request.user if request else None
+
+    def tag_to_dict(self, tag):
+        return {
+            'id': tag.id,
+            'name': tag.name,
+            'color': tag.color,
+            'slug': tag.slug,
+        }
+
+    def author_to_dict(self, author):
+        user = self.get_user()
+        if hasattr(author, 'is_subscribed'):
+            is_subscribed = author.is_subscribed
+        else:
+            is_subscribed = bool(
+                user and user.is_authenticated
+                and user.follower.filter(following=author).exists()
+            )
+        return {
+            'email': author.email,
+            'id': author.id,
+            'username': author.username,
+            'first_name': author.first_name,
+            'last_name': author.last_name,
+            'is_subscribed': is_subscribed,
+        }
+
+    def ingredient_to_dict(self, position):
+        return {
+            'id': position.id,
+            'name': position.ingredient.name,
+            'measurement_unit': position.ingredient.measurement_unit,
+            'amount': position.amount,
+        }
+
+    def get_flag(self, obj, model, annotation):
+        if hasattr(obj, annotation):
+            return getattr(obj, annotation)
+        user = self.get_user()
         return model.objects.filter(
-            user=request.user.pk,
+            user=user.pk if user else None,
             recipe=obj.pk
         ).exists()
 
+    def get_id(self, obj):
+        return obj.id
+
+    def get_tags(self, obj):
+        return [self.tag_to_dict(tag) for tag in obj.tags.all()]
+
+    def get_author(self, obj):
+        return self.author_to_dict(obj.author)
+
+    def get_ingredients(self, obj):
+        return [
+            self.ingredient_to_dict(position)
+            for position in obj.rel_RecipeIngredient.all()
+        ]
+
     def get_is_favorited(self, obj):
-        """ Находится ли в избранном """
-        return self.is_model_instance_exist(obj=obj, model=Favorite)
+        return self.get_flag(obj, Favorite, 'is_favorited')
 
     def get_is_in_shopping_cart(self, obj):
-        """ Находится ли в списке покупок """
-        return self.is_model_instance_exist(obj=obj, model=ShoppingList)
+        return self.get_flag(obj, ShoppingList, 'is_in_shopping_cart')
 
-    def get_image_url(self, obj):
-        if obj.image:
-            return obj.image.url
-        return None
+    def get_name(self, obj):
+        return obj.name
+
+    def get_image(self, obj):
+        return obj.image.url if obj.image else None
+
+    def get_text(self, obj):
+        return obj.text
+
+    def get_cooking_time(self, obj):
+        return obj.cooking_time
+
+    def get_favorites_count(self, obj):
+        return obj.favorites_count
+
+    def get_field_getters(self):
+        """ Поля ответа с учетом ?fields= / ?omit= (считаем один раз)"""
+        if not hasattr(self, '_field_getters'):
+            self._field_getters = [
+                (name, getattr(self, f'get_{name}'))
+                for name in select_fields(
+                    self.field_names, self.context.get('sparse_fields')
+                )
+            ]
+        return self._field_getters
+
+    def to_representation(self, obj):
+        return {
+            name: getter(obj) for name, getter in self.get_field_getters()
+        }
 
 
 class RecipeShortListSerializer(serializers.ModelSerializer):
@@ -225,7 +274,8 @@ class RecipeShortListSerializer(serializers.ModelSerializer):
 class RecipeCreateSerializer(
     serializers.ModelSerializer,
     RecipeRelationMixin,
-    RecipeCreateValidationMixin
+    RecipeCreateValidationMixin,
+    RecipePrefetchMixin
 ):
     """ Сериализатор создания рецепта"""
     author = UserListSerializer(
@@ -292,19 +342,34 @@ class RecipeCreateSerializer(
             else:
                 setattr(instance, attr, value)
 
-        instance.save()
-        instance.rel_RecipeIngredient.all().delete()
-        field = getattr(instance, 'tags')
-        field.clear()
-
-        return self.create_ingredient_tags_recipe(
-            instance,
-            ingredients_data,
-            tags_data
-        )
+        with transaction.atomic():
+            instance.save()
+            old_ingredient_ids = recipe_ingredient_ids(instance.pk)
+            instance.rel_RecipeIngredient.all().delete()
+            field = getattr(instance, 'tags')
+            field.clear()
+
+            instance = self.create_ingredient_tags_recipe(
+                instance,
+                ingredients_data,
+                tags_data
+            )
+            # Суммы в корзинах, где есть рецепт
+            refresh_recipe_ingredients(
+                instance.pk,
+                set(old_ingredient_ids) | {
+                    ingredient['id'].pk for ingredient in ingredients_data
+                }
+            )
+        return instance
 
     def to_representation(self, instance):
-        return RecipeListSerializer(
+        request = self.context.get('request')
+        user = request.user if request else None
+        instance = self.prefetch_recipe_relations(
+            Recipe.objects.filter(pk=instance.pk), user
+        ).get()
+        return RecipeReadSerializer(
             context=self.context,
             instance=instance
         ).data
@@ -330,14 +395,18 @@ class FollowReadListSerializer(UserListSerializer):
 
     def get_recipes(self, obj):
         """" Чтение всех рецептов юзера, с учетом лимита (если есть)"""
-        request = self.context.get('request')
-        recipes_limit = None
-        if request:
-            recipes_limit = request.query_params.get('recipes_limit')
-
-        recipes = obj.recipes.all()
-        if recipes_limit:
-            recipes = recipes[:int(recipes_limit)]
+        if hasattr(obj, 'subscription_recipes'):
+            # Уже с лимитом (см. SubscriptionPrefetchMixin)
+            recipes = obj.subscription_recipes
+        else:
+            request = self.context.get('request')
+            recipes_limit = None
+            if request:
+                recipes_limit = request.query_params.get('recipes_limit')
+
+            recipes = obj.recipes.all()
+            if recipes_limit:
+                recipes = recipes[:int(recipes_limit)]
 
         serializer = RecipeShortListSerializer(
             recipes,
@@ -347,6 +416,8 @@ class FollowReadListSerializer(UserListSerializer):
 
     def get_recipes_count(self, obj):
         """ Счетчик кол-ва рецептов юзера"""
+        if hasattr(obj, 'recipes_count'):
+            return obj.recipes_count
         return obj.recipes.all().count()
 
 
@@ -438,3 +509,31 @@ class ShoppingListSerializer(serializers.ModelSerializer):
             context=self.context,
             instance=instance.recipe
         ).data
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    """ Фоновая выгрузка списка покупок: создание и статус"""
+    format = serializers.ChoiceField(
+        source='file_format',
+        choices=list(SHOPPING_LIST_RENDERERS),
+        default=lambda: settings.ATTACHMENT_FORMAT
+    )
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ExportJob
+        fields = (
+            'id', 'format', 'status', 'error',
+            'created_at', 'finished_at', 'download_url'
+        )
+        read_only_fields = (
+            'id', 'status', 'error', 'created_at', 'finished_at'
+        )
+
+    def get_download_url(self, obj):
+        """ Ссылка на файл, когда он готов"""
+        if obj.status != ExportJob.DONE:
+            return None
+        url = reverse('exports-download', args=[obj.pk])
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
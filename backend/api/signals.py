@@ -0,0 +1,112 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import response_cache
+from recipes.models import (Ingredient, Recipe, RecipeIngredient, TableVersion,
+                            Tag)
+from users.models import User
+
+
+def invalidate_on_commit(*recipe_ids):
+    """ Сбросить кэш после коммита, без id - весь кэш
+
+    Сброс внутри транзакции дал бы анонимному GET до коммита
+    закэшировать старые данные еще на timeout.
+    """
+    def invalidate():
+        if not recipe_ids:
+            response_cache.invalidate_all()
+        for pk in recipe_ids:
+            response_cache.invalidate_recipe(pk)
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def invalidate_recipe(sender, instance, **kwargs):
+    """ Изменился сам рецепт"""
+    invalidate_on_commit(instance.pk)
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def invalidate_recipe_ingredients(sender, instance, **kwargs):
+    """ Изменился состав рецепта"""
+    invalidate_on_commit(instance.recipe_id)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_tags(sender, instance, action, reverse, pk_set,
+                           **kwargs):
+    """ Изменились теги рецепта"""
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_on_commit(instance.pk)
+    elif pk_set:
+        invalidate_on_commit(*pk_set)
+    else:
+        # post_clear со стороны тега - рецепты неизвестны
+        invalidate_on_commit()
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_reference(sender, **kwargs):
+    """ Теги и ингредиенты встроены во все рецепты"""
+    invalidate_on_commit()
+
+
+@receiver(post_save, sender=User)
+def invalidate_author(sender, update_fields=None, **kwargs):
+    """ Данные автора встроены в рецепты, last_login не отображается"""
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    invalidate_on_commit()
+
+
+def touch_recipes(**lookup):
+    """ Обновить updated_at рецептов без вызова save()"""
+    Recipe.objects.filter(**lookup).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def touch_recipe_ingredients(sender, instance, **kwargs):
+    touch_recipes(pk=instance.recipe_id)
+
+
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def touch_recipe_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # После очистки связей у тега рецепты уже не найти
+        touch_recipes(tags=instance)
+    elif not action.startswith('post_'):
+        return
+    elif not reverse:
+        touch_recipes(pk=instance.pk)
+    elif pk_set:
+        touch_recipes(pk__in=pk_set)
+
+
+@receiver(post_save, sender=User)
+def touch_author_recipes(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    touch_recipes(author=instance)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def bump_tag_version(sender, **kwargs):
+    TableVersion.bump('tag')
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def bump_ingredient_version(sender, **kwargs):
+    TableVersion.bump('ingredient')
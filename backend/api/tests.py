@@ -0,0 +1,583 @@
+import io
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock, skipIf
+
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from .cache import (DjangoCacheBackend, LRUCacheBackend, RecipeResponseCache,
+                    response_cache)
+from .export_jobs import claim_next_job, purge_expired, run_job
+from .ingredient_index import ingredient_index
+from recipes import aggregation
+from recipes.aggregation import ShoppingColumns, aggregate_columns
+from recipes.models import (ExportJob, Favorite, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingList, Tag, TimelineEntry)
+from recipes.timeline import push_returning_authors
+from users.models import Follow, User
+
+PAGE_SIZE = 6
+
+
+class RecipeFixturesMixin:
+    """ Class mixin with users, tags, ingredients and recipes"""
+
+    def setUp(self):
+        response_cache.backend.clear()
+        # Версии таблиц откатываются вместе с транзакцией теста
+        ingredient_index.version = None
+        self.author = User.objects.create_user(
+            username='author', email='author@example.com', password='pass'
+        )
+        self.user = User.objects.create_user(
+            username='user', email='user@example.com', password='pass'
+        )
+        self.tags = [
+            Tag.objects.create(name=f'Тег {i}', color=f'#00000{i}',
+                               slug=f'tag{i}')
+            for i in range(2)
+        ]
+        self.ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit=unit)
+            for name, unit in (('мука', 'г'), ('молоко', 'мл'))
+        ]
+        self.anon_client = APIClient()
+        self.user_client = APIClient()
+        self.user_client.force_authenticate(self.user)
+
+    def create_recipes(self, count):
+        recipes = []
+        for i in range(count):
+            recipe = Recipe.objects.create(
+                author=self.author, name=f'Рецепт {i}', text='Текст',
+                cooking_time=10
+            )
+            recipe.tags.set(self.tags)
+            for amount, ingredient in enumerate(self.ingredients, 1):
+                RecipeIngredient.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=amount
+                )
+            recipes.append(recipe)
+        return recipes
+
+    def count_queries(self, client, url):
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+
+class RecipeListQueriesTest(RecipeFixturesMixin, TestCase):
+    """ Число запросов списка рецептов не зависит от размера страницы"""
+
+    def setUp(self):
+        super().setUp()
+        for recipe in self.create_recipes(PAGE_SIZE):
+            Favorite.objects.create(user=self.user, recipe=recipe)
+            ShoppingList.objects.create(user=self.user, recipe=recipe)
+
+    def assert_constant_queries(self, client):
+        single = self.count_queries(client, '/api/recipes/?limit=1')
+        with self.assertNumQueries(single):
+            response = client.get(f'/api/recipes/?limit={PAGE_SIZE}')
+        self.assertEqual(len(response.data['results']), PAGE_SIZE)
+        return response
+
+    def test_anonymous(self):
+        self.assert_constant_queries(self.anon_client)
+
+    def test_authenticated(self):
+        response = self.assert_constant_queries(self.user_client)
+        for recipe in response.data['results']:
+            self.assertTrue(recipe['is_favorited'])
+            self.assertTrue(recipe['is_in_shopping_cart'])
+
+
+class RecipeCursorPaginationTest(RecipeFixturesMixin, TestCase):
+    """ Курсорный режим списка рецептов"""
+
+    def setUp(self):
+        super().setUp()
+        self.recipes = self.create_recipes(3)
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.anon_client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [recipe['id'] for recipe in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_default_ordering(self):
+        ids = self.walk('/api/recipes/?pagination=cursor&limit=2')
+        self.assertEqual(ids, [recipe.pk for recipe in self.recipes][::-1])
+
+    def test_with_search(self):
+        ids = self.walk('/api/recipes/?search=Рецепт&pagination=cursor')
+        self.assertEqual(len(ids), len(self.recipes))
+
+    def test_with_ordering_param(self):
+        ids = self.walk(
+            '/api/recipes/?pagination=cursor&ordering=pub_date&limit=2'
+        )
+        self.assertEqual(ids, [recipe.pk for recipe in self.recipes])
+
+    def test_other_ordering_falls_back_to_pages(self):
+        response = self.anon_client.get(
+            '/api/recipes/?pagination=cursor&ordering=-favorites_count'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], len(self.recipes))
+        self.assertNotIn('cursor=', response.data['next'] or '')
+
+
+class FavoriteCounterCacheTest(RecipeFixturesMixin, TestCase):
+    """ Избранное сбрасывает кэш ответа и дату изменения рецепта"""
+
+    def setUp(self):
+        super().setUp()
+        [self.recipe] = self.create_recipes(1)
+        self.url = f'/api/recipes/{self.recipe.pk}/?fields=favorites_count'
+
+    def get_count(self):
+        response = self.anon_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.data['favorites_count']
+
+    def test_favorite_invalidates_cache(self):
+        self.assertEqual(self.get_count(), 0)
+        updated_at = Recipe.objects.get(pk=self.recipe.pk).updated_at
+        favorite_url = f'/api/recipes/{self.recipe.pk}/favorite/'
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.user_client.post(favorite_url)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.get_count(), 1)
+        self.assertGreater(
+            Recipe.objects.get(pk=self.recipe.pk).updated_at, updated_at
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.user_client.delete(favorite_url)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.get_count(), 0)
+
+
+class ResponseCacheVersionTest(SimpleTestCase):
+    """ Версии кэша ответов не откатываются назад"""
+
+    def setUp(self):
+        self.request = Request(APIRequestFactory().get('/api/recipes/'))
+
+    def test_version_outlives_page_timeout(self):
+        clock = [1000.0]
+        backend = LRUCacheBackend(max_entries=2, timeout=300)
+        cache = RecipeResponseCache(backend)
+        with mock.patch('api.cache.time.monotonic', lambda: clock[0]):
+            cache.invalidate_recipe(1)
+            clock[0] += 200
+            cache.set(cache.list_key(self.request), 'до правки')
+            # Прежний ключ версии истек бы здесь, страница - еще нет
+            clock[0] += 150
+            cache.invalidate_recipe(1)
+            self.assertIsNone(cache.get(cache.list_key(self.request)))
+
+    def test_version_survives_eviction(self):
+        backend = LRUCacheBackend(max_entries=1)
+        cache = RecipeResponseCache(backend)
+        cache.invalidate_recipe(1)
+        key = cache.list_key(self.request)
+        cache.set(key, 'до правки')
+        for pk in range(2, 5):
+            cache.set(cache.detail_key(pk), 'рецепт')
+        cache.invalidate_recipe(1)
+        self.assertNotEqual(cache.list_key(self.request), key)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }})
+    def test_django_backend_lost_version_key(self):
+        backend = DjangoCacheBackend()
+        cache = RecipeResponseCache(backend)
+        cache.invalidate_recipe(1)
+        key = cache.list_key(self.request)
+        cache.set(key, 'до правки')
+        backend.cache.delete('recipes:list:version')
+        later = time.time_ns() + 10 ** 9
+        with mock.patch('api.cache.time.time_ns', lambda: later):
+            cache.invalidate_recipe(1)
+        self.assertNotEqual(cache.list_key(self.request), key)
+        self.assertIsNone(cache.get(cache.list_key(self.request)))
+
+
+class ResponseCacheInvalidationTest(RecipeFixturesMixin, TestCase):
+    """ Кэш ответов сбрасывается только после коммита записи"""
+
+    def setUp(self):
+        super().setUp()
+        [self.recipe] = self.create_recipes(1)
+        self.url = f'/api/recipes/{self.recipe.pk}/'
+
+    def get(self):
+        response = self.anon_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_invalidated_on_commit(self):
+        self.assertEqual(self.get()['X-Cache'], 'MISS')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.recipe.name = 'Новое'
+            self.recipe.save()
+            # До коммита в кэше прежний ответ
+            self.assertEqual(self.get()['X-Cache'], 'HIT')
+        self.assertTrue(callbacks)
+        for callback in callbacks:
+            callback()
+        response = self.get()
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['name'], 'Новое')
+
+    def test_stats_staff_only(self):
+        self.get()
+        self.get()
+        response = self.user_client.get('/api/recipes/cache_stats/')
+        self.assertEqual(response.status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.user_client.get('/api/recipes/cache_stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response.data['hits'], 1)
+        self.assertGreaterEqual(response.data['misses'], 1)
+
+
+class AggregateColumnsTest(SimpleTestCase):
+    """ Суммы списка покупок обоими способами: цикл и NumPy"""
+    ingredients = {
+        1: ('мука', 'г'),
+        2: ('мука', 'кг'),
+        3: ('соль', 'г'),
+        4: ('молоко', 'л'),
+        5: ('вода', 'мл'),
+        6: ('вода', 'л'),
+    }
+    # (ингредиент, кол-во, порядок первого появления)
+    rows = (
+        (3, 5, 10),
+        (2, 2, 20),
+        (6, 1, 50),
+        (1, 300, 30),
+        (4, 1, 5),
+        (5, 250, 45),
+        (1, 100, 40),
+    )
+    expected = [
+        (4, 'молоко', 'л', 1),
+        (3, 'соль', 'г', 5),
+        (1, 'мука', 'г', 2400),
+        (5, 'вода', 'мл', 1250),
+    ]
+
+    def aggregate(self, numpy_min_rows):
+        columns = ShoppingColumns()
+        for ingredient_id, amount, order in self.rows:
+            columns.ingredient_ids.append(ingredient_id)
+            columns.amounts.append(amount)
+            columns.order.append(order)
+        with mock.patch.object(
+            aggregation, 'NUMPY_MIN_ROWS', numpy_min_rows
+        ):
+            return [
+                (ingredient.id, ingredient.name,
+                 ingredient.measurement_unit, total)
+                for ingredient, total in aggregate_columns(
+                    columns, self.ingredients
+                )
+            ]
+
+    def test_python(self):
+        self.assertEqual(self.aggregate(len(self.rows) + 1), self.expected)
+
+    @skipIf(aggregation.numpy is None, 'NumPy не установлен')
+    def test_numpy(self):
+        with mock.patch.object(
+            aggregation, 'reduce_python', side_effect=AssertionError
+        ):
+            self.assertEqual(self.aggregate(0), self.expected)
+
+    def test_empty(self):
+        self.assertEqual(aggregate_columns(ShoppingColumns(), {}), [])
+
+
+class ShoppingListDownloadQueriesTest(RecipeFixturesMixin, TestCase):
+    """ Выгрузка списка покупок не делает запросов на каждый рецепт"""
+    url = '/api/recipes/download_shopping_cart/?format=txt'
+
+    def add_to_cart(self, recipes):
+        for recipe in recipes:
+            response = self.user_client.post(
+                f'/api/recipes/{recipe.pk}/shopping_cart/'
+            )
+            self.assertEqual(response.status_code, 201)
+
+    def download(self):
+        response = self.user_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_constant_queries(self):
+        self.add_to_cart(self.create_recipes(1))
+        with CaptureQueriesContext(connection) as context:
+            self.download()
+        single = len(context.captured_queries)
+
+        self.add_to_cart(self.create_recipes(5))
+        with self.assertNumQueries(single):
+            content = self.download()
+        self.assertIn('Рецепт 4', content)
+        # 6 рецептов по 1 г муки и 2 мл молока
+        self.assertIn('мука (г) --- 6', content)
+        self.assertIn('молоко (мл) --- 12', content)
+
+    def test_anonymous(self):
+        for query in ('', '?format=txt', '?format=pdf'):
+            with self.subTest(query=query):
+                response = self.anon_client.get(
+                    f'/api/recipes/download_shopping_cart/{query}'
+                )
+                self.assertEqual(response.status_code, 401)
+                self.assertEqual(response['Content-Type'], 'application/json')
+
+
+class ExportJobTest(RecipeFixturesMixin, TestCase):
+    """ Фоновые выгрузки: файл вне MEDIA_ROOT, старые удаляются"""
+
+    def setUp(self):
+        super().setUp()
+        export_root = tempfile.TemporaryDirectory()
+        self.addCleanup(export_root.cleanup)
+        settings = override_settings(EXPORT_ROOT=export_root.name)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.export_root = export_root.name
+        [recipe] = self.create_recipes(1)
+        response = self.user_client.post(
+            f'/api/recipes/{recipe.pk}/shopping_cart/'
+        )
+        self.assertEqual(response.status_code, 201)
+
+    def export(self):
+        response = self.user_client.post('/api/exports/', {'format': 'txt'})
+        self.assertEqual(response.status_code, 202)
+        return run_job(claim_next_job())
+
+    def test_download(self):
+        job = self.export()
+        self.assertEqual(job.status, ExportJob.DONE)
+        self.assertTrue(job.file.path.startswith(self.export_root))
+        response = self.user_client.get(f'/api/exports/{job.pk}/download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('мука (г) --- 1', b''.join(response).decode())
+
+    def test_purge_expired(self):
+        old, new = self.export(), self.export()
+        ExportJob.objects.filter(pk=old.pk).update(
+            finished_at=timezone.now() - timedelta(hours=25)
+        )
+        self.assertEqual(purge_expired(timedelta(hours=24)), 1)
+        self.assertFalse(os.path.exists(old.file.path))
+        self.assertTrue(os.path.exists(new.file.path))
+        self.assertEqual(
+            list(ExportJob.objects.values_list('pk', flat=True)), [new.pk]
+        )
+
+
+class SubscriptionQueriesTest(RecipeFixturesMixin, TestCase):
+    """ Число запросов подписок не зависит от авторов и рецептов"""
+    url = f'/api/users/subscriptions/?limit={PAGE_SIZE}'
+
+    def follow_authors(self, count):
+        for _ in range(count):
+            self.author = User.objects.create_user(
+                username=f'author{User.objects.count()}',
+                email=f'author{User.objects.count()}@example.com'
+            )
+            self.create_recipes(3)
+            Follow.objects.create(user=self.user, following=self.author)
+
+    def test_constant_queries(self):
+        self.follow_authors(1)
+        cases = {'': 3, '&recipes_limit=2': 2}
+        single = {
+            query: self.count_queries(self.user_client, self.url + query)
+            for query in cases
+        }
+        self.follow_authors(PAGE_SIZE - 1)
+        for query, recipes in cases.items():
+            with self.subTest(query=query):
+                with self.assertNumQueries(single[query]):
+                    response = self.user_client.get(self.url + query)
+                results = response.data['results']
+                self.assertEqual(len(results), PAGE_SIZE)
+                for author in results:
+                    self.assertTrue(author['is_subscribed'])
+                    self.assertEqual(author['recipes_count'], 3)
+                    self.assertEqual(len(author['recipes']), recipes)
+
+
+class FeedTest(RecipeFixturesMixin, TestCase):
+    """ Лента подписок: раскладка рецептов и курсор"""
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.user_client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [recipe['id'] for recipe in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_followed_recipes_newest_first(self):
+        old = self.create_recipes(2)
+        response = self.user_client.post(
+            f'/api/users/{self.author.pk}/subscribe/'
+        )
+        self.assertEqual(response.status_code, 201)
+        new = self.create_recipes(2)
+        expected = [recipe.pk for recipe in old + new][::-1]
+        self.assertEqual(self.walk('/api/recipes/feed/?limit=3'), expected)
+
+        Follow.objects.filter(user=self.user).delete()
+        self.assertEqual(self.walk('/api/recipes/feed/'), [])
+
+    def test_anonymous(self):
+        response = self.anon_client.get('/api/recipes/feed/')
+        self.assertEqual(response.status_code, 401)
+
+    @mock.patch('recipes.timeline.PULL_FOLLOWERS', 3)
+    @mock.patch('recipes.timeline.PUSH_FOLLOWERS', 2)
+    def test_pull_push_hysteresis(self):
+        expected = [recipe.pk for recipe in self.create_recipes(2)][::-1]
+        users = [self.user] + [
+            User.objects.create_user(
+                username=f'follower{i}', email=f'follower{i}@example.com'
+            )
+            for i in range(2)
+        ]
+        follows = [
+            Follow.objects.create(user=user, following=self.author)
+            for user in users
+        ]
+        entries = TimelineEntry.objects.filter(author=self.author)
+        self.author.refresh_from_db()
+        self.assertTrue(self.author.timeline_pulled)
+        self.assertFalse(entries.exists())
+
+        # Отписки не раскладывают рецепты обратно в запросе
+        follows.pop().delete()
+        follows.pop().delete()
+        self.author.refresh_from_db()
+        self.assertTrue(self.author.timeline_pulled)
+        self.assertFalse(entries.exists())
+        self.assertEqual(self.walk('/api/recipes/feed/'), expected)
+
+        self.assertEqual(push_returning_authors(), 1)
+        self.author.refresh_from_db()
+        self.assertFalse(self.author.timeline_pulled)
+        self.assertEqual(entries.count(), 2)
+        self.assertEqual(self.walk('/api/recipes/feed/'), expected)
+
+
+class IngredientSearchTest(RecipeFixturesMixin, TestCase):
+    """ Поиск ингредиентов по ?name="""
+
+    def setUp(self):
+        super().setUp()
+        self.extra = Ingredient.objects.create(
+            name='сухое молоко', measurement_unit='г'
+        )
+
+    def test_prefix_first(self):
+        response = self.anon_client.get('/api/ingredients/?name=мол')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [item['name'] for item in response.data],
+            ['молоко', 'сухое молоко']
+        )
+
+    def test_retrieve_ignores_search(self):
+        pk = self.ingredients[0].pk
+        for name in ('мук', 'молоко'):
+            response = self.anon_client.get(
+                f'/api/ingredients/{pk}/?name={name}'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['name'], 'мука')
+
+
+class RecipeUserRelationFilterTest(RecipeFixturesMixin, TestCase):
+    """ Фильтры is_favorited / is_in_shopping_cart"""
+
+    def setUp(self):
+        super().setUp()
+        self.recipes = self.create_recipes(3)
+        Favorite.objects.create(user=self.user, recipe=self.recipes[0])
+        ShoppingList.objects.create(user=self.user, recipe=self.recipes[0])
+        ShoppingList.objects.create(user=self.user, recipe=self.recipes[1])
+
+    def get_ids(self, client, query):
+        response = client.get(f'/api/recipes/?{query}')
+        self.assertEqual(response.status_code, 200)
+        return {recipe['id'] for recipe in response.data['results']}
+
+    def ids(self, *positions):
+        return {self.recipes[position].pk for position in positions}
+
+    def test_include_and_exclude(self):
+        cases = (
+            ('is_favorited=1', self.ids(0)),
+            ('is_favorited=0', self.ids(1, 2)),
+            ('is_in_shopping_cart=1', self.ids(0, 1)),
+            ('is_in_shopping_cart=0', self.ids(2)),
+            ('is_favorited=0&is_in_shopping_cart=1', self.ids(1)),
+        )
+        for query, expected in cases:
+            with self.subTest(query=query):
+                self.assertEqual(
+                    self.get_ids(self.user_client, query), expected
+                )
+
+    def test_anonymous_ignored(self):
+        self.assertEqual(
+            self.get_ids(self.anon_client, 'is_favorited=1'),
+            self.ids(0, 1, 2)
+        )
+
+
+class LoadCsvErrorsTest(TestCase):
+    """ Ошибки формата файла ингредиентов - CommandError с номером"""
+
+    def load(self, suffix, content):
+        with tempfile.NamedTemporaryFile(
+            'w', suffix=suffix, encoding='UTF-8', delete=False
+        ) as file:
+            file.write(content)
+        self.addCleanup(os.unlink, file.name)
+        call_command('load_csv', file.name, stdout=io.StringIO())
+
+    def test_short_csv_row(self):
+        with self.assertRaisesMessage(CommandError, 'Строка 3'):
+            self.load('.csv', 'мука,г\nмолоко,мл\nсоль\n')
+
+    def test_json_missing_key(self):
+        with self.assertRaisesMessage(CommandError, 'Объект 2'):
+            self.load('.json', '[{"name": "мука", "measurement_unit": "г"},'
+                               ' {"name": "соль"}]')
@@ -1,14 +1,15 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import (CustomUserViewSet, IngredientViewSet, RecipeViewSet,
-                    TagViewSet)
+from .views import (CustomUserViewSet, ExportJobViewSet, IngredientViewSet,
+                    RecipeViewSet, TagViewSet)
 
 router = DefaultRouter()
 router.register(r'users', CustomUserViewSet, basename='users')
 router.register(r'tags', TagViewSet, basename='tags')
 router.register(r'recipes', RecipeViewSet, basename='recipes')
 router.register(r'ingredients', IngredientViewSet, basename='ingredients')
+router.register(r'exports', ExportJobViewSet, basename='exports')
 
 
 urlpatterns = [
@@ -1,32 +1,44 @@
-from typing import Optional
-
 from django.conf import settings
+from django.http import FileResponse
+from django_filters.rest_framework import DjangoFilterBackend
 from djoser.permissions import CurrentUserOrAdmin
 from djoser.views import UserViewSet as DjoserUserViewSet
-from rest_framework import permissions, viewsets
+from rest_framework import filters, mixins, permissions, status, viewsets
 from rest_framework.decorators import action
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 
+from .cache import (AnonymousResponseCacheMixin, ReferenceBytesCacheMixin,
+                    response_cache)
+from .conditional import (conditional_method, recipe_etag,
+                          recipe_last_modified, table_etag,
+                          table_last_modified)
 from .filters import (CustomSearchFilter, RecipeCustomFilter,
                       RecipeViewSetFilter)
 from .helpers import ShoppingListDownloadHelper
-from .mixins import UserRelatedModelMixin
-from .pagination import CustomPageNumberPagination
+from .mixins import (RecipePrefetchMixin, SparseFieldsMixin,
+                     SubscriptionPrefetchMixin, UserRelatedModelMixin,
+                     select_fields)
+from .pagination import (CustomPageNumberPagination, FeedCursorPagination,
+                         RecipePagination)
 from .permissions import AuthorUserOrAdmin
-from .serializers import (FavoriteSerializer, FollowReadListSerializer,
-                          FollowSerializer, IngredientSerializer,
-                          RecipeCreateSerializer, RecipeIngredientSerializer,
-                          RecipeListSerializer, ShoppingListSerializer,
-                          TagSerializer)
-from recipes.models import (Favorite, Ingredient, Recipe, RecipeIngredient,
-                            ShoppingList, Tag)
+from .renderers import SHOPPING_LIST_RENDERERS, get_shopping_list_renderers
+from .serializers import (ExportJobSerializer, FavoriteSerializer,
+                          FollowReadListSerializer, FollowSerializer,
+                          IngredientSerializer, RecipeCreateSerializer,
+                          RecipeIngredientSerializer, RecipeReadSerializer,
+                          ShoppingListSerializer, TagSerializer)
+from recipes.models import (ExportJob, Favorite, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingList, Tag)
+from recipes.timeline import read_timeline
 from users.models import Follow, User
 
 
 class CustomUserViewSet(
+    SparseFieldsMixin,
     DjoserUserViewSet,
-    UserRelatedModelMixin
+    UserRelatedModelMixin,
+    SubscriptionPrefetchMixin
 ):
     queryset = User.objects.all()
     search_fields = ('username', 'email')
@@ -51,24 +63,21 @@ class CustomUserViewSet(
             url_path='subscriptions',
             )
     def subscriptions(self, request):
-        """ Метод вывода списка подписок юзера"""
-        user: User = request.user
-        subscribtions: Follow = user.follower.all()
-        user_list = [follow_obj.following.id for follow_obj in subscribtions]
+        """ Метод вывода списка подписок юзера
 
-        # Создадим кверисет, с объектами модели Юзера, для всех подписок.
-        queryset = User.objects.filter(pk__in=user_list)
+        Кол-во запросов не зависит от числа авторов и рецептов,
+        см. SubscriptionPrefetchMixin.
+        """
+        queryset = self.subscriptions_queryset(request.user)
 
         page = self.paginate_queryset(queryset)
-        context = {
-            'request': request,
-            'subscribtions': True
-        }
+        authors = page if page is not None else list(queryset)
+        self.prefetch_author_recipes(authors, self.get_recipes_limit())
+        context = self.get_serializer_context()
+        context['subscribtions'] = True
+        serializer = self.get_serializer(authors, many=True, context=context)
         if page is not None:
-            serializer = self.get_serializer(page, many=True, context=context)
             return self.get_paginated_response(serializer.data)
-
-        serializer = self.get_serializer(queryset, many=True, context=context)
         return Response(serializer.data)
 
     @action(detail=True,
@@ -95,18 +104,33 @@ class CustomUserViewSet(
 
 
 # app classes - recipes
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(ReferenceBytesCacheMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     pagination_class = None
+    version_table = 'tag'
 
+    @conditional_method(table_etag('tag'), table_last_modified('tag'))
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+
+class IngredientViewSet(
+    ReferenceBytesCacheMixin,
+    viewsets.ReadOnlyModelViewSet
+):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
     filter_backends = (CustomSearchFilter,)
     search_fields = ('^name',)
+    version_table = 'ingredient'
+
+    @conditional_method(
+        table_etag('ingredient'), table_last_modified('ingredient')
+    )
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
 
 class RecipeIngredientViewSet(viewsets.ModelViewSet):
@@ -115,49 +139,67 @@ class RecipeIngredientViewSet(viewsets.ModelViewSet):
 
 
 class RecipeViewSet(
+    AnonymousResponseCacheMixin,
+    SparseFieldsMixin,
     viewsets.ModelViewSet,
     UserRelatedModelMixin,
     ShoppingListDownloadHelper,
-    RecipeCustomFilter
+    RecipeCustomFilter,
+    RecipePrefetchMixin
 ):
     """ Обработка эндпоинта /recipes"""
     queryset = Recipe.objects.all()
     filterset_class = RecipeViewSetFilter
-    pagination_class = CustomPageNumberPagination
+    pagination_class = RecipePagination
+    filter_backends = (DjangoFilterBackend, filters.OrderingFilter)
+    ordering_fields = ('pub_date', 'favorites_count')
 
     def get_permissions(self):
         """ Переопределим полномочия в зависимости от действия"""
-        if self.request.method in permissions.SAFE_METHODS:
+        if self.action in ('feed', 'download_shopping_cart'):
+            self.permission_classes = [IsAuthenticated, ]
+        elif self.action == 'cache_stats':
+            self.permission_classes = [IsAdminUser, ]
+        elif self.request.method in permissions.SAFE_METHODS:
             # allow GET, HEAD or OPTIONS requests
             self.permission_classes = [AllowAny, ]
         else:
             self.permission_classes = [AuthorUserOrAdmin, ]
         return super().get_permissions()
 
+    def get_renderers(self):
+        """ Для выгрузки списка покупок - рендеры форматов файла"""
+        if getattr(self, 'action', None) == 'download_shopping_cart':
+            return [
+                renderer() for renderer in get_shopping_list_renderers(
+                    settings.ATTACHMENT_FORMAT
+                )
+            ]
+        return super().get_renderers()
+
     def get_queryset(self):
-        """ Добавим фильтр по Избранному, на уровне queryset"""
-        query_params: Optional[dict] = {}
-        if self.request.user.is_authenticated:
-            query_params = self.request.query_params
-
-        if query_params.get(self.FAVORITE_PARAM) is not None:
-            queryset = self.get_filtered_queryset(
-                query_param=self.FAVORITE_PARAM,
-                user=self.request.user
+        """ Добавим флаги избранного и списка покупок, на уровне queryset
+
+        Фильтры is_favorited / is_in_shopping_cart - в RecipeViewSetFilter.
+        """
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve', 'feed'):
+            fields = select_fields(
+                RecipeReadSerializer.field_names, self.get_sparse_fields()
             )
-        elif query_params.get(self.SHOPPING_CART_PARAM) is not None:
-            queryset = self.get_filtered_queryset(
-                query_param=self.SHOPPING_CART_PARAM,
-                user=self.request.user
+            queryset = self.prefetch_recipe_relations(
+                queryset, self.request.user, fields
             )
-        else:
-            queryset = super().get_queryset()
-        return queryset
+        return self.annotate_user_flags(queryset, self.request.user)
+
+    @conditional_method(recipe_etag, recipe_last_modified)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
 
     def get_serializer_class(self):
         """ Определим какой сериализатор выдать"""
-        if self.action in ('list', 'retrieve'):
-            return RecipeListSerializer
+        if self.action in ('list', 'retrieve', 'feed'):
+            return RecipeReadSerializer
         return RecipeCreateSerializer
 
     def perform_create(self, serializer):
@@ -213,29 +255,48 @@ class RecipeViewSet(
             url_path='download_shopping_cart'
             )
     def download_shopping_cart(self, request):
-        """ Метод выгрузки списка продуктов"""
-        user = request.user
-        shopping_list = user.users_shoppinglist.all(
-        ).prefetch_related('recipe')
-
-        final_list: dict = {}
-        recipe_list: list = []
-        # Сбор данных рецептов в список
-        for item in shopping_list:
-            ingredient_list = item.recipe.rel_RecipeIngredient.all()
-
-            for position in ingredient_list:
-                if position.ingredient in final_list:
-                    final_list[position.ingredient] += position.amount
-                else:
-                    final_list[position.ingredient] = position.amount
-            recipe_list.append(f'# {item.recipe.name}')
-
-        return self.create_file(
-            file_format=settings.ATTACHMENT_FORMAT,
-            array1=recipe_list,
-            array2=final_list
+        """ Метод выгрузки списка продуктов
+
+        Формат: ?format=csv|pdf|txt|json или заголовок Accept,
+        по умолчанию settings.ATTACHMENT_FORMAT.
+        """
+        recipe_list, final_list = self.get_shopping_list(request.user)
+        return request.accepted_renderer.export(recipe_list, final_list)
+
+    @action(detail=False,
+            methods=['get'],
+            permission_classes=(IsAuthenticated,),
+            pagination_class=FeedCursorPagination,
+            )
+    def feed(self, request):
+        """ Лента: новые рецепты авторов, на которых подписан юзер
+
+        Страница - ?limit=, следующая - по ссылке next (?cursor=).
+        """
+        recipe_ids = self.paginator.paginate_feed(
+            lambda limit, position: read_timeline(
+                request.user, limit, position
+            ),
+            request
+        )
+        recipes = self.get_queryset().in_bulk(recipe_ids)
+        serializer = self.get_serializer(
+            [recipes[pk] for pk in recipe_ids if pk in recipes], many=True
         )
+        return self.paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False,
+            methods=['get'],
+            permission_classes=(IsAdminUser,),
+            url_path='cache_stats'
+            )
+    def cache_stats(self, request):
+        """ Счетчики попаданий/промахов кэша ответов для анонимов
+
+        Счетчики свои у каждого процесса: отвечает тот воркер,
+        которому достался запрос.
+        """
+        return Response(response_cache.stats())
 
 
 class FollowViewSet(viewsets.ModelViewSet):
@@ -251,3 +312,61 @@ class FavoriteViewSet(viewsets.ModelViewSet):
 class ShoppingListViewSet(viewsets.ModelViewSet):
     queryset = ShoppingList.objects.all()
     serializer_class = ShoppingListSerializer
+
+
+class ExportJobViewSet(
+    mixins.CreateModelMixin,
+    mixins.RetrieveModelMixin,
+    mixins.ListModelMixin,
+    viewsets.GenericViewSet
+):
+    """ Фоновые выгрузки списка покупок
+
+    POST создает задачу (202), GET /exports/{id}/ - статус,
+    GET /exports/{id}/download/ - готовый файл. Файлы рендерит
+    воркер: python manage.py export_worker.
+    """
+    serializer_class = ExportJobSerializer
+    permission_classes = (IsAuthenticated,)
+    pagination_class = CustomPageNumberPagination
+
+    def get_queryset(self):
+        return ExportJob.objects.filter(user=self.request.user)
+
+    def get_renderers(self):
+        """ Файл можно запросить с Accept его формата"""
+        renderers = super().get_renderers()
+        if getattr(self, 'action', None) == 'download':
+            renderers += [
+                renderer() for renderer in SHOPPING_LIST_RENDERERS.values()
+            ]
+        return renderers
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        """ Готовый файл выгрузки"""
+        job = self.get_object()
+        if job.status != ExportJob.DONE:
+            return Response(
+                {
+                    'detail': 'Файл еще не готов',
+                    'status': job.status,
+                    'error': job.error,
+                },
+                status=status.HTTP_409_CONFLICT
+            )
+        renderer = SHOPPING_LIST_RENDERERS[job.file_format]
+        return FileResponse(
+            job.file.open('rb'),
+            as_attachment=True,
+            filename=f'{renderer.filename}.{renderer.format}',
+            content_type=renderer.media_type
+        )
@@ -130,6 +130,12 @@ STATIC_ROOT = BASE_DIR / 'collected_static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Файлы фоновых выгрузок списка покупок: вне MEDIA_ROOT, nginx их
+# не раздает, отдает только /api/exports/{id}/download/ владельцу.
+# Воркер удаляет выгрузки старше EXPORT_RETENTION_HOURS.
+EXPORT_ROOT = os.path.join(BASE_DIR, 'exports')
+EXPORT_RETENTION_HOURS = 24
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -145,6 +151,17 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.TokenAuthentication',
     ],
 
+    # orjson, если установлен, иначе stdlib json
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     'PAGE_SIZE': 6,
@@ -170,5 +187,17 @@ DJOSER = {
 }
 
 # Settings for endpoint /api/recipes/download_shopping_cart/
-# Values: 'csv', 'pdf'
+# Default format when the client sends neither ?format= nor Accept
+# Values: 'csv', 'pdf', 'txt', 'json'
 ATTACHMENT_FORMAT = 'pdf'
+
+# Кэш ответов /api/recipes/ для анонимных пользователей.
+# Для нескольких воркеров можно указать общий кэш:
+# 'BACKEND': 'api.cache.DjangoCacheBackend', 'OPTIONS': {'alias': 'default'}
+RECIPE_RESPONSE_CACHE = {
+    'BACKEND': 'api.cache.LRUCacheBackend',
+    'OPTIONS': {
+        'max_entries': 1024,
+        'timeout': 300,
+    },
+}
@@ -8,6 +8,7 @@ class RecipeAdmin(admin.ModelAdmin):
     list_display = ('name', 'author', 'favorite_counter', 'pub_date')
     list_filter = ('author', 'name', 'tags')
     filter_horizontal = ('ingredients', 'tags')
+    readonly_fields = ('favorites_count', 'shopping_count')
 
 
 class IngredientAdmin(admin.ModelAdmin):
@@ -0,0 +1,155 @@
+from array import array
+
+from .models import Ingredient
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Единица измерения -> (базовая единица, множитель)
+UNIT_CONVERSIONS = {
+    'г': ('г', 1),
+    'кг': ('г', 1000),
+    'мл': ('мл', 1),
+    'л': ('мл', 1000),
+}
+CURSOR_CHUNK_SIZE = 2000
+# На коротких списках цикл быстрее подготовки массивов NumPy
+NUMPY_MIN_ROWS = 1000
+
+
+def base_unit(unit):
+    return UNIT_CONVERSIONS.get(unit, (unit, 1))
+
+
+class ShoppingColumns:
+    """ Колонки строк списка покупок: ингредиент, кол-во, порядок"""
+
+    def __init__(self):
+        self.ingredient_ids = array('q')
+        self.amounts = array('q')
+        self.order = array('q')
+
+    @classmethod
+    def from_queryset(cls, queryset):
+        """ Колонки из ShoppingListIngredient (одного или многих юзеров)"""
+        columns = cls()
+        rows = queryset.order_by().values_list(
+            'ingredient', 'amount', 'first_seen'
+        ).iterator(chunk_size=CURSOR_CHUNK_SIZE)
+        for ingredient_id, amount, first_seen in rows:
+            columns.ingredient_ids.append(ingredient_id)
+            columns.amounts.append(amount)
+            columns.order.append(first_seen)
+        return columns
+
+    def __len__(self):
+        return len(self.ingredient_ids)
+
+
+def plan_groups(ingredients):
+    """ Группа и множитель для каждого ингредиента
+
+    ingredients - {id: (название, единица)}. В группу попадают
+    продукты с одним названием и базовой единицей ("г" и "кг").
+    Одиночный продукт остается в своей единице, группа из нескольких
+    пересчитывается в базовую.
+    """
+    members = {}
+    for pk, (name, unit) in ingredients.items():
+        members.setdefault((name, base_unit(unit)[0]), []).append(pk)
+
+    groups, group_of, factor_of = [], {}, {}
+    for (name, unit), ingredient_ids in members.items():
+        code = len(groups)
+        if len(ingredient_ids) == 1:
+            [pk] = ingredient_ids
+            groups.append(Ingredient(
+                id=pk, name=name, measurement_unit=ingredients[pk][1]
+            ))
+            group_of[pk], factor_of[pk] = code, 1
+            continue
+        groups.append(Ingredient(
+            id=min(ingredient_ids), name=name, measurement_unit=unit
+        ))
+        for pk in ingredient_ids:
+            group_of[pk] = code
+            factor_of[pk] = base_unit(ingredients[pk][1])[1]
+    return groups, group_of, factor_of
+
+
+def reduce_numpy(columns, group_of, factor_of, group_count):
+    ids = numpy.frombuffer(columns.ingredient_ids, dtype=numpy.int64)
+    amounts = numpy.frombuffer(columns.amounts, dtype=numpy.int64)
+    order = numpy.frombuffer(columns.order, dtype=numpy.int64)
+
+    distinct, inverse = numpy.unique(ids, return_inverse=True)
+    codes = numpy.array(
+        [group_of[pk] for pk in distinct.tolist()], dtype=numpy.int64
+    )[inverse]
+    factors = numpy.array(
+        [factor_of[pk] for pk in distinct.tolist()], dtype=numpy.int64
+    )[inverse]
+
+    totals = numpy.zeros(group_count, dtype=numpy.int64)
+    numpy.add.at(totals, codes, amounts * factors)
+    missing = numpy.iinfo(numpy.int64).max
+    first_seen = numpy.full(group_count, missing, dtype=numpy.int64)
+    numpy.minimum.at(first_seen, codes, order)
+    return totals.tolist(), [
+        None if value == missing else value for value in first_seen.tolist()
+    ]
+
+
+def reduce_python(columns, group_of, factor_of, group_count):
+    totals = [0] * group_count
+    first_seen = [None] * group_count
+    for pk, amount, order in zip(
+        columns.ingredient_ids, columns.amounts, columns.order
+    ):
+        code = group_of[pk]
+        totals[code] += amount * factor_of[pk]
+        if first_seen[code] is None or order < first_seen[code]:
+            first_seen[code] = order
+    return totals, first_seen
+
+
+def aggregate_columns(columns, ingredients):
+    """ Суммы по продуктам с приведением единиц
+
+    ingredients - {id: (название, единица)} для всех id из колонок.
+    Возвращает пары (ингредиент, кол-во) в порядке первого появления.
+    Длинные колонки суммирует NumPy (группировка по коду группы),
+    короткие или без NumPy - цикл.
+    """
+    if not len(columns):
+        return []
+    groups, group_of, factor_of = plan_groups(ingredients)
+    reduce = reduce_python
+    if numpy is not None and len(columns) >= NUMPY_MIN_ROWS:
+        reduce = reduce_numpy
+    totals, first_seen = reduce(columns, group_of, factor_of, len(groups))
+    present = [
+        code for code in range(len(groups)) if first_seen[code] is not None
+    ]
+    present.sort(key=first_seen.__getitem__)
+    return [(groups[code], totals[code]) for code in present]
+
+
+def aggregate_shopping_list(queryset):
+    """ Итоговый список покупок по строкам ShoppingListIngredient
+
+    queryset - строки одного юзера или нескольких (общая выгрузка).
+    Два запроса: колонки строк и названия их ингредиентов.
+    """
+    columns = ShoppingColumns.from_queryset(queryset)
+    if not len(columns):
+        return []
+    ingredients = {
+        pk: (name, unit)
+        for pk, name, unit in Ingredient.objects.filter(
+            pk__in=queryset.order_by().values('ingredient')
+        ).values_list('pk', 'name', 'measurement_unit')
+    }
+    return aggregate_columns(columns, ingredients)
@@ -1,38 +1,140 @@
 import csv
+import json
+import re
+import time
+from itertools import islice
+from pathlib import Path
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from recipes.models import Ingredient
+from recipes.models import Ingredient, TableVersion
 
-# import subprocess
+DEFAULT_PATH = 'static/data/ingredients.csv'
+DEFAULT_BATCH_SIZE = 1000
+JSON_CHUNK_SIZE = 64 * 1024
+FIELDS = ('name', 'measurement_unit')
+# Разделители между объектами JSON массива или JSON Lines
+JSON_SEPARATORS = re.compile(r'[\s\[\],]*')
 
-models_1 = [
-    (Ingredient, 'ingredients.csv')
-]
 
-# Если нужны связи
-# models_2 = [
-#     ('recipes_ingredients', 'ingredients.csv')
-# ]
+def iter_csv(file):
+    """ Строки CSV (name, measurement_unit), заголовок необязателен"""
+    reader = csv.reader(file)
+    for row in reader:
+        if not row or tuple(row) == FIELDS:
+            continue
+        if len(row) < len(FIELDS):
+            raise CommandError(
+                f'Строка {reader.line_num}: ожидается {len(FIELDS)} '
+                f'колонки ({", ".join(FIELDS)}), получено {len(row)}'
+            )
+        yield row[0], row[1]
+
+
+def iter_json(file):
+    """ Объекты JSON массива (или JSON Lines) по одному
+
+    Файл читается кусками по JSON_CHUNK_SIZE, в памяти держится
+    только недочитанный хвост.
+    """
+    decoder = json.JSONDecoder()
+    buffer, position, eof = '', 0, False
+    number = 0
+    while True:
+        position = JSON_SEPARATORS.match(buffer, position).end()
+        try:
+            if position == len(buffer):
+                raise ValueError
+            obj, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                if position < len(buffer):
+                    raise CommandError(
+                        f'Ошибка JSON около: {buffer[position:][:50]}'
+                    )
+                return
+            chunk = file.read(JSON_CHUNK_SIZE)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        number += 1
+        try:
+            row = obj['name'], obj['measurement_unit']
+        except (KeyError, TypeError):
+            raise CommandError(
+                f'Объект {number}: нужны ключи {", ".join(FIELDS)}, '
+                f'получено {str(obj)[:50]}'
+            )
+        yield row
+
+
+READERS = {
+    'csv': iter_csv,
+    'json': iter_json,
+}
 
 
 class Command(BaseCommand):
-    help_text = 'load ingredient models'
+    help = (
+        'Загрузка ингредиентов из CSV или JSON пачками через bulk_create. '
+        'Повторный запуск не создает дублей (name, measurement_unit).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            nargs='?',
+            default=DEFAULT_PATH,
+            help=f'Файл с ингредиентами (по умолчанию {DEFAULT_PATH})',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=DEFAULT_BATCH_SIZE,
+            help='Кол-во строк в одном INSERT',
+        )
+        parser.add_argument(
+            '--format',
+            choices=READERS,
+            help='Формат файла, по умолчанию по расширению',
+        )
 
     def handle(self, *args, **options):
-        # log_file = open('load_csv.log', 'w', encoding='UTF-8')
-        path = 'static/data/'
-        records = {}
-        for model, file_name in models_1:
-            with open(f'{path}{file_name}', 'r', encoding='UTF-8') as file:
-                rows = csv.DictReader(file)
-                records[model.__name__] = [
-                    model.objects.create(**row) for row in rows
+        path = Path(options['path'])
+        file_format = options['format'] or path.suffix.lstrip('.').lower()
+        if file_format not in READERS:
+            raise CommandError(f'Неизвестный формат файла: {path}')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size должен быть больше 0')
+
+        count_before = Ingredient.objects.count()
+        started = time.monotonic()
+        total = 0
+        with open(path, 'r', encoding='UTF-8', newline='') as file:
+            rows = READERS[file_format](file)
+            while True:
+                batch = [
+                    Ingredient(
+                        name=name.strip(),
+                        measurement_unit=measurement_unit.strip()
+                    )
+                    for name, measurement_unit in islice(
+                        rows, options['batch_size']
+                    )
                 ]
-            self.stdout.write(self.style.SUCCESS(f'Done {file_name}'))
-        # for model, file_name in models_2:
-        #     s = subprocess.call([
-        #         'sqlite3', 'db.sqlite3', '.mode csv',
-        #         f'.import {path}{file_name} {model}'
-        #     ], stderr=log_file)
-        #     self.stdout.write(self.style.SUCCESS(f'Done {file_name}'))
+                if not batch:
+                    break
+                Ingredient.objects.bulk_create(batch, ignore_conflicts=True)
+                total += len(batch)
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{total} строк...')
+
+        # bulk_create не вызывает сигналы - сбросим кэши справочника
+        TableVersion.bump('ingredient')
+
+        elapsed = time.monotonic() - started
+        created = Ingredient.objects.count() - count_before
+        self.stdout.write(self.style.SUCCESS(
+            f'Done {path}: {total} строк, новых {created}, '
+            f'{elapsed:.1f} с, {total / max(elapsed, 1e-6):.0f} строк/с'
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from recipes.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Полная переиндексация рецептов для поиска ?search='
+
+    def handle(self, *args, **options):
+        total = rebuild_search_index()
+        self.stdout.write(
+            self.style.SUCCESS(f'Переиндексировано рецептов: {total}')
+        )
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.shopping import (BATCH_SIZE, find_stale_users,
+                              refresh_shopping_totals, shopping_user_ids)
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересборка сумм ингредиентов в корзинах (ShoppingListIngredient)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только показать юзеров с расхождениями, ничего не менять',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = shopping_user_ids()
+        if options['check']:
+            stale = set()
+            for start in range(0, len(user_ids), BATCH_SIZE):
+                stale |= find_stale_users(user_ids[start:start + BATCH_SIZE])
+            self.stdout.write(
+                f'Юзеров: {len(user_ids)}, с расхождениями: {len(stale)}'
+            )
+            if stale and options['verbosity'] > 1:
+                self.stdout.write(', '.join(map(str, sorted(stale))))
+            return
+
+        for start in range(0, len(user_ids), BATCH_SIZE):
+            with transaction.atomic():
+                refresh_shopping_totals(user_ids[start:start + BATCH_SIZE])
+        self.stdout.write(
+            self.style.SUCCESS(f'Пересчитано корзин: {len(user_ids)}')
+        )
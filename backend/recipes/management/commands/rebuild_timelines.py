@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.timeline import push_returning_authors, rebuild_timelines
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчет подписчиков авторов и пересборка лент подписок '
+        '(TimelineEntry)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--returning',
+            action='store_true',
+            help=(
+                'Только разложить по лентам рецепты авторов, у которых '
+                'стало мало подписчиков (запускать по cron)'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        if options['returning']:
+            with transaction.atomic():
+                authors = push_returning_authors()
+            self.stdout.write(
+                self.style.SUCCESS(f'Авторов вернулось в ленты: {authors}')
+            )
+            return
+
+        with transaction.atomic():
+            authors = rebuild_timelines()
+        self.stdout.write(
+            self.style.SUCCESS(f'Авторов в лентах: {authors}')
+        )
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Recipe, ShoppingList
+
+BATCH_SIZE = 1000
+
+
+def count_relations(model):
+    """ Подзапрос с фактическим кол-вом связей рецепта"""
+    return Coalesce(
+        Subquery(
+            model.objects.filter(recipe=OuterRef('pk'))
+            .order_by().values('recipe')
+            .annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+class Command(BaseCommand):
+    help = 'Сверка счетчиков favorites_count / shopping_count у рецептов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только показать расхождения, ничего не исправлять',
+        )
+
+    def handle(self, *args, **options):
+        stale_ids = list(
+            Recipe.objects.annotate(
+                real_favorites=count_relations(Favorite),
+                real_shopping=count_relations(ShoppingList),
+            ).exclude(
+                favorites_count=F('real_favorites'),
+                shopping_count=F('real_shopping'),
+            ).values_list('pk', flat=True)
+        )
+        if options['check']:
+            self.stdout.write(f'Расхождений: {len(stale_ids)}')
+            return
+
+        for start in range(0, len(stale_ids), BATCH_SIZE):
+            Recipe.objects.filter(
+                pk__in=stale_ids[start:start + BATCH_SIZE]
+            ).update(
+                favorites_count=count_relations(Favorite),
+                shopping_count=count_relations(ShoppingList),
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f'Исправлено рецептов: {len(stale_ids)}')
+        )
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.3 on 2026-10-18 19:05
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_relations(model):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(recipe=OuterRef('pk'))
+            .order_by().values('recipe')
+            .annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    ShoppingList = apps.get_model('recipes', 'ShoppingList')
+    Recipe.objects.update(
+        favorites_count=count_relations(Favorite),
+        shopping_count=count_relations(ShoppingList)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_recipe_updated_at_tableversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(db_index=True, default=0, verbose_name='В избранном (кол-во)'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='shopping_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='В списках покупок (кол-во)'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
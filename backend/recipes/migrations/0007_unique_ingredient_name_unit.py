@@ -0,0 +1,65 @@
+# Generated by Django 3.2.3 on 2026-10-18 19:10
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+# Как recipes.models.MAX_AMOUNT на момент миграции
+MAX_AMOUNT = 32000
+
+
+def merge_duplicate_ingredients(apps, schema_editor):
+    """ Повторный запуск load_csv мог создать дубли ингредиентов.
+    Оставляем ингредиент с меньшим id и переносим на него рецепты,
+    если в рецепте были оба - количества складываются.
+    """
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    duplicates = Ingredient.objects.values(
+        'name', 'measurement_unit'
+    ).annotate(keep_id=Min('id'), total=Count('id')).filter(total__gt=1)
+    for group in duplicates:
+        extra_ids = list(
+            Ingredient.objects.filter(
+                name=group['name'],
+                measurement_unit=group['measurement_unit']
+            ).exclude(pk=group['keep_id']).values_list('pk', flat=True)
+        )
+        kept = {
+            position.recipe_id: position
+            for position in RecipeIngredient.objects.filter(
+                ingredient_id=group['keep_id']
+            )
+        }
+        for position in RecipeIngredient.objects.filter(
+            ingredient_id__in=extra_ids
+        ):
+            survivor = kept.get(position.recipe_id)
+            if survivor is not None:
+                # Дубль в том же рецепте: количество складываем
+                survivor.amount = min(
+                    survivor.amount + position.amount, MAX_AMOUNT
+                )
+                survivor.save(update_fields=['amount'])
+                position.delete()
+                continue
+            position.ingredient_id = group['keep_id']
+            position.save(update_fields=['ingredient'])
+            kept[position.recipe_id] = position
+        Ingredient.objects.filter(pk__in=extra_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            merge_duplicate_ingredients, migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(fields=('name', 'measurement_unit'), name='unique_ingredient_name_unit'),
+        ),
+    ]
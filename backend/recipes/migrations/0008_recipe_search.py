@@ -0,0 +1,51 @@
+# Generated by Django 3.2.3 on 2026-10-18 19:16
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+SEARCH_CONFIG = 'russian'
+
+
+class AddPostgresIndex(migrations.AddIndex):
+    """ GIN индекс по tsvector есть только в PostgreSQL"""
+
+    def database_forwards(self, app_label, schema_editor, *args):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(app_label, schema_editor, *args)
+
+    def database_backwards(self, app_label, schema_editor, *args):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(app_label, schema_editor, *args)
+
+
+def fill_search_index(apps, schema_editor):
+    """ tsvector для существующих рецептов (только PostgreSQL)"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Recipe.objects.update(search_vector=(
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0007_unique_ingredient_name_unit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый вектор'),
+        ),
+        AddPostgresIndex(
+            model_name='recipe',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='recipe_search_vector_gin'),
+        ),
+        migrations.RunPython(fill_search_index, migrations.RunPython.noop),
+    ]
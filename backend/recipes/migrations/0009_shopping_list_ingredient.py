@@ -0,0 +1,69 @@
+# Generated by Django 3.2.3 on 2026-10-18 19:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import F, Min, Sum
+
+# Как recipes.shopping на момент миграции
+BATCH_SIZE = 1000
+ORDER_KEY_BASE = 2 ** 32
+
+
+def fill_shopping_totals(apps, schema_editor):
+    RecipeIngredient = apps.get_model('recipes', 'RecipeIngredient')
+    ShoppingListIngredient = apps.get_model(
+        'recipes', 'ShoppingListIngredient'
+    )
+    rows = RecipeIngredient.objects.filter(
+        recipe__recipe_shoppinglists__isnull=False
+    ).values('recipe__recipe_shoppinglists__user', 'ingredient').annotate(
+        total=Sum('amount'),
+        first_seen=Min(F('recipe') * ORDER_KEY_BASE + F('pk'))
+    ).order_by()
+    ShoppingListIngredient.objects.bulk_create(
+        (
+            ShoppingListIngredient(
+                user_id=row['recipe__recipe_shoppinglists__user'],
+                ingredient_id=row['ingredient'],
+                amount=row['total'],
+                first_seen=row['first_seen']
+            )
+            for row in rows.iterator()
+        ),
+        batch_size=BATCH_SIZE
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipes', '0008_recipe_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveIntegerField(default=0, verbose_name='Количество')),
+                ('first_seen', models.BigIntegerField(default=0, verbose_name='Порядок в выгрузке')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list_totals', to='recipes.ingredient', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list_ingredients', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Сумма в списке покупок',
+                'verbose_name_plural': 'Суммы в списках покупок',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='shoppinglistingredient',
+            index=models.Index(fields=['user', 'first_seen'], name='shopping_total_order_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='shoppinglistingredient',
+            constraint=models.UniqueConstraint(fields=('user', 'ingredient'), name='unique_user_shopping_ingredient'),
+        ),
+        migrations.RunPython(fill_shopping_totals, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,14 @@
+import os
+
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.files.storage import FileSystemStorage
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.utils import timezone
 
 MIN_AMOUNT = 1
 MAX_AMOUNT = 32000
@@ -35,6 +42,12 @@ class Ingredient(models.Model):
         ordering = ['name']
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'measurement_unit'],
+                name='unique_ingredient_name_unit'
+            )
+        ]
 
     def __str__(self):
         return ('{n} ({u})').format(n=self.name, u=self.measurement_unit)
@@ -85,18 +98,48 @@ class Recipe(models.Model):
         verbose_name='Дата публикации',
         auto_now_add=True
     )
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+        auto_now=True
+    )
+    favorites_count = models.PositiveIntegerField(
+        verbose_name='В избранном (кол-во)',
+        default=0,
+        db_index=True
+    )
+    shopping_count = models.PositiveIntegerField(
+        verbose_name='В списках покупок (кол-во)',
+        default=0
+    )
+    search_vector = SearchVectorField(
+        verbose_name='Поисковый вектор',
+        null=True,
+        editable=False
+    )
 
     @admin.display(
         description='Избранное (кол-во чел)',
+        ordering='favorites_count',
     )
     def favorite_counter(self):
         """ Вывод в админку счетчик у рецепта"""
-        return self.recipe_favorites.count()
+        return self.favorites_count
 
     class Meta:
         ordering = ['-pub_date']
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            # Создается только на PostgreSQL, см. миграцию 0008
+            GinIndex(
+                fields=['search_vector'], name='recipe_search_vector_gin'
+            ),
+            # Новые рецепты авторов для ленты подписок
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='recipe_author_pub_date_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -183,3 +226,175 @@ class ShoppingList(models.Model):
 
     def __str__(self):
         return self.user.username
+
+
+class ShoppingListIngredient(models.Model):
+    """ Сумма ингредиента по всем рецептам корзины юзера
+
+    Поддерживается при изменении корзины и состава рецептов
+    (см. recipes.shopping), чтобы выгрузка читала готовые суммы.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь',
+        related_name='shopping_list_ingredients'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Ингредиент',
+        related_name='shopping_list_totals'
+    )
+    amount = models.PositiveIntegerField('Количество', default=0)
+    first_seen = models.BigIntegerField('Порядок в выгрузке', default=0)
+
+    class Meta:
+        verbose_name = 'Сумма в списке покупок'
+        verbose_name_plural = 'Суммы в списках покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_user_shopping_ingredient'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', 'first_seen'], name='shopping_total_order_idx'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} - {self.ingredient}: {self.amount}'
+
+
+class TimelineEntry(models.Model):
+    """ Рецепт в ленте подписчика автора
+
+    Раскладывается при публикации (см. recipes.timeline). Рецепты
+    авторов с большим числом подписчиков сюда не пишутся,
+    лента подмешивает их при чтении.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name='Подписчик',
+        related_name='timeline_entries'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        verbose_name='Рецепт',
+        related_name='timeline_entries'
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name='Автор',
+        related_name='+'
+    )
+    pub_date = models.DateTimeField('Дата публикации рецепта')
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи лент'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_user_timeline_recipe'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-recipe'],
+                name='timeline_user_order_idx'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} - {self.recipe}'
+
+
+class ExportStorage(FileSystemStorage):
+    """ Хранилище выгрузок в settings.EXPORT_ROOT, без публичного URL"""
+
+    @property
+    def base_location(self):
+        return settings.EXPORT_ROOT
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+
+class ExportJob(models.Model):
+    """ Задача фоновой выгрузки списка покупок
+
+    Создается через API, файл рендерит воркер (команда export_worker),
+    очередь - сама таблица.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    )
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь',
+        related_name='export_jobs'
+    )
+    file_format = models.CharField('Формат', max_length=8)
+    status = models.CharField(
+        'Статус', max_length=16, choices=STATUS_CHOICES, default=PENDING
+    )
+    file = models.FileField(
+        'Файл', storage=ExportStorage(), null=True, blank=True
+    )
+    error = models.TextField('Ошибка', blank=True)
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+    started_at = models.DateTimeField('Начата', null=True, blank=True)
+    finished_at = models.DateTimeField('Завершена', null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'Выгрузка'
+        verbose_name_plural = 'Выгрузки'
+        indexes = [
+            models.Index(
+                fields=['status', 'created_at'], name='export_job_queue_idx'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user} {self.file_format} ({self.status})'
+
+
+class TableVersion(models.Model):
+    """ Версия содержимого таблицы для условных GET запросов"""
+    table = models.CharField('Таблица', max_length=64, unique=True)
+    version = models.PositiveIntegerField('Версия', default=0)
+    updated_at = models.DateTimeField('Дата изменения', default=timezone.now)
+
+    class Meta:
+        verbose_name = 'Версия таблицы'
+        verbose_name_plural = 'Версии таблиц'
+
+    def __str__(self):
+        return f'{self.table} v{self.version}'
+
+    @classmethod
+    def bump(cls, table):
+        """ Увеличить версию таблицы после изменения данных"""
+        updated = cls.objects.filter(table=table).update(
+            version=models.F('version') + 1,
+            updated_at=timezone.now()
+        )
+        if not updated:
+            cls.objects.get_or_create(table=table, defaults={'version': 1})
@@ -0,0 +1,62 @@
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connection
+from django.db.models import F, FloatField, Q, Value
+
+from .models import Recipe
+
+SEARCH_CONFIG = 'russian'
+BATCH_SIZE = 1000
+
+
+def use_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def recipe_search_vector():
+    """ Выражение для колонки Recipe.search_vector"""
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+    )
+
+
+def update_search_index(recipe_ids):
+    """ Пересчитать tsvector рецептов после изменения названия или описания
+
+    Колонка есть только на PostgreSQL, на других базах - ничего.
+    """
+    if use_postgres():
+        Recipe.objects.filter(pk__in=recipe_ids).update(
+            search_vector=recipe_search_vector()
+        )
+
+
+def rebuild_search_index():
+    """ Переиндексировать все рецепты пачками, вернуть их кол-во"""
+    recipe_ids = list(
+        Recipe.objects.order_by('pk').values_list('pk', flat=True)
+    )
+    for start in range(0, len(recipe_ids), BATCH_SIZE):
+        update_search_index(recipe_ids[start:start + BATCH_SIZE])
+    return len(recipe_ids)
+
+
+def search_recipes(queryset, query):
+    """ Рецепты, подходящие под запрос, с релевантностью search_rank
+
+    Полнотекстовый поиск (индекс GIN) - только на PostgreSQL. Другие базы
+    годятся лишь для локальной разработки: там все слова запроса ищутся
+    подстрокой в названии или описании, без ранжирования.
+    """
+    if use_postgres():
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        return queryset.filter(search_vector=search_query).annotate(
+            search_rank=SearchRank(F('search_vector'), search_query)
+        )
+
+    for word in query.split():
+        queryset = queryset.filter(
+            Q(name__icontains=word) | Q(text__icontains=word)
+        )
+    return queryset.annotate(search_rank=Value(0.0, FloatField()))
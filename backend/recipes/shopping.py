@@ -0,0 +1,132 @@
+from django.db import transaction
+from django.db.models import F, Min, Sum
+
+from .models import RecipeIngredient, ShoppingList, ShoppingListIngredient
+from users.models import User
+
+# Множитель для ключа порядка (id рецепта, id строки рецепта)
+ORDER_KEY_BASE = 2 ** 32
+BATCH_SIZE = 1000
+
+
+def compute_shopping_totals(users, ingredient_ids=None, exclude_recipe=None):
+    """ Суммы ингредиентов по корзинам юзеров, считает база
+
+    first_seen - ключ первого появления ингредиента: по id рецепта,
+    затем по id строки рецепта.
+    """
+    positions = RecipeIngredient.objects.filter(
+        recipe__recipe_shoppinglists__user__in=users
+    )
+    if ingredient_ids is not None:
+        positions = positions.filter(ingredient__in=ingredient_ids)
+    if exclude_recipe is not None:
+        positions = positions.exclude(recipe=exclude_recipe)
+    return positions.values(
+        'recipe__recipe_shoppinglists__user', 'ingredient'
+    ).annotate(
+        total=Sum('amount'),
+        first_seen=Min(F('recipe') * ORDER_KEY_BASE + F('pk'))
+    ).order_by()
+
+
+def refresh_shopping_totals(users, ingredient_ids=None, exclude_recipe=None):
+    """ Пересчитать строки ShoppingListIngredient для юзеров
+
+    Пересчитываются только пары (юзер, ингредиент) из ingredient_ids,
+    без него - вся корзина. Вызывать внутри транзакции изменения.
+    Строки юзеров блокируются до конца транзакции: параллельные
+    изменения одной корзины пересчитываются по очереди и не вставляют
+    одну пару дважды.
+    """
+    with transaction.atomic():
+        list(User.objects.select_for_update().filter(
+            pk__in=users
+        ).order_by('pk').values_list('pk', flat=True))
+        stored = ShoppingListIngredient.objects.filter(user__in=users)
+        if ingredient_ids is not None:
+            stored = stored.filter(ingredient__in=ingredient_ids)
+        stored.delete()
+        ShoppingListIngredient.objects.bulk_create(
+            [
+                ShoppingListIngredient(
+                    user_id=row['recipe__recipe_shoppinglists__user'],
+                    ingredient_id=row['ingredient'],
+                    amount=row['total'],
+                    first_seen=row['first_seen']
+                )
+                for row in compute_shopping_totals(
+                    users, ingredient_ids, exclude_recipe
+                )
+            ],
+            batch_size=BATCH_SIZE
+        )
+
+
+def recipe_ingredient_ids(recipe_id):
+    return list(
+        RecipeIngredient.objects.filter(
+            recipe=recipe_id
+        ).values_list('ingredient', flat=True)
+    )
+
+
+def cart_users(recipe_id):
+    """ Подзапрос юзеров, у которых рецепт в корзине"""
+    return ShoppingList.objects.filter(recipe=recipe_id).values('user')
+
+
+def refresh_cart_recipe(user_id, recipe_id):
+    """ Рецепт добавлен в корзину юзера или убран из нее"""
+    ingredient_ids = recipe_ingredient_ids(recipe_id)
+    if ingredient_ids:
+        refresh_shopping_totals([user_id], ingredient_ids)
+
+
+def refresh_recipe_ingredients(recipe_id, ingredient_ids):
+    """ Изменился состав рецепта: старые и новые ингредиенты"""
+    if ingredient_ids:
+        refresh_shopping_totals(cart_users(recipe_id), ingredient_ids)
+
+
+def remove_recipe_totals(recipe_id):
+    """ Рецепт удаляется: вычесть его из всех корзин до удаления"""
+    ingredient_ids = recipe_ingredient_ids(recipe_id)
+    if ingredient_ids:
+        refresh_shopping_totals(
+            cart_users(recipe_id), ingredient_ids, exclude_recipe=recipe_id
+        )
+
+
+def shopping_user_ids():
+    """ Юзеры с корзиной или с сохраненными суммами"""
+    return sorted(
+        set(ShoppingList.objects.values_list('user', flat=True).distinct())
+        | set(
+            ShoppingListIngredient.objects.values_list(
+                'user', flat=True
+            ).distinct()
+        )
+    )
+
+
+def find_stale_users(user_ids):
+    """ Юзеры, у которых суммы в таблице расходятся с корзиной"""
+    expected = {
+        (row['recipe__recipe_shoppinglists__user'], row['ingredient']): (
+            row['total'], row['first_seen']
+        )
+        for row in compute_shopping_totals(user_ids)
+    }
+    stored = {
+        (user, ingredient): (amount, first_seen)
+        for user, ingredient, amount, first_seen in (
+            ShoppingListIngredient.objects.filter(
+                user__in=user_ids
+            ).values_list('user', 'ingredient', 'amount', 'first_seen')
+        )
+    }
+    return {
+        user for user, ingredient in expected.keys() | stored.keys()
+        if expected.get((user, ingredient)) != stored.get((user, ingredient))
+    }
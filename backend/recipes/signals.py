@@ -0,0 +1,38 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .models import Recipe
+from .search import update_search_index
+from .shopping import remove_recipe_totals
+from .timeline import add_follower, fan_out_recipe, remove_follower
+from users.models import Follow
+
+
+@receiver(post_save, sender=Recipe)
+def publish_recipe(sender, instance, created, **kwargs):
+    """ Новый рецепт - в ленты подписчиков автора"""
+    if created:
+        fan_out_recipe(instance)
+
+
+@receiver(post_save, sender=Recipe)
+def index_recipe(sender, instance, **kwargs):
+    """ Название или описание могли измениться"""
+    update_search_index([instance.pk])
+
+
+@receiver(pre_delete, sender=Recipe)
+def remove_recipe_from_carts(sender, instance, **kwargs):
+    """ Суммы корзин без удаляемого рецепта, в транзакции удаления"""
+    remove_recipe_totals(instance.pk)
+
+
+@receiver(post_save, sender=Follow)
+def follow_author(sender, instance, created, **kwargs):
+    if created:
+        add_follower(instance.user_id, instance.following_id)
+
+
+@receiver(post_delete, sender=Follow)
+def unfollow_author(sender, instance, **kwargs):
+    remove_follower(instance.user_id, instance.following_id)
@@ -0,0 +1,174 @@
+from heapq import merge
+from itertools import islice
+
+from django.db.models import Count, F, Q
+
+from .models import Recipe, TimelineEntry
+from users.models import Follow, User
+
+# Рецепты авторов с таким кол-вом подписчиков не раскладываются
+# по лентам при публикации, а подмешиваются при чтении
+PULL_FOLLOWERS = 1000
+# Обратно к раскладке - только когда подписчиков стало заметно меньше,
+# чтобы автор на границе не переключался при каждой (от)писке
+PUSH_FOLLOWERS = 800
+BATCH_SIZE = 1000
+
+
+def is_pulled(author_id):
+    return User.objects.filter(pk=author_id, timeline_pulled=True).exists()
+
+
+def push_recipes(recipes, user_ids):
+    """ Записать рецепты в ленты юзеров (повторы пропускаются)"""
+    recipes = list(recipes.values_list('pk', 'author', 'pub_date'))
+    entries = (
+        TimelineEntry(
+            user_id=user_id, recipe_id=pk, author_id=author_id,
+            pub_date=pub_date
+        )
+        for user_id in user_ids
+        for pk, author_id, pub_date in recipes
+    )
+    while True:
+        batch = list(islice(entries, BATCH_SIZE))
+        if not batch:
+            return
+        TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def follower_ids(author_id):
+    """ Подписчики автора (раскладка только для авторов, где их немного)"""
+    return list(Follow.objects.filter(following=author_id).values_list(
+        'user', flat=True
+    ))
+
+
+def fan_out_recipe(recipe):
+    """ Разложить новый рецепт по лентам подписчиков автора"""
+    if is_pulled(recipe.author_id):
+        return
+    push_recipes(Recipe.objects.filter(pk=recipe.pk), follower_ids(
+        recipe.author_id
+    ))
+
+
+def add_follower(user_id, author_id):
+    """ Подписка: счетчик автора и его рецепты в ленту юзера"""
+    User.objects.filter(pk=author_id).update(
+        followers_count=F('followers_count') + 1
+    )
+    switched = User.objects.filter(
+        pk=author_id, timeline_pulled=False,
+        followers_count__gte=PULL_FOLLOWERS
+    ).update(timeline_pulled=True)
+    if switched:
+        # Автор перешел в подмешиваемые при чтении
+        TimelineEntry.objects.filter(author=author_id).delete()
+    elif not is_pulled(author_id):
+        push_recipes(Recipe.objects.filter(author=author_id), [user_id])
+
+
+def remove_follower(user_id, author_id):
+    """ Отписка: счетчик автора и его рецепты из ленты юзера
+
+    Обратно к раскладке автор переходит не здесь, а в
+    push_returning_authors: раскладка всех его рецептов по всем
+    подписчикам слишком тяжела для запроса отписки.
+    """
+    User.objects.filter(pk=author_id, followers_count__gt=0).update(
+        followers_count=F('followers_count') - 1
+    )
+    TimelineEntry.objects.filter(user=user_id, author=author_id).delete()
+
+
+def push_authors(author_ids):
+    for author_id in author_ids:
+        push_recipes(
+            Recipe.objects.filter(author=author_id), follower_ids(author_id)
+        )
+
+
+def push_returning_authors():
+    """ Вернуть к раскладке авторов, у которых мало подписчиков
+
+    Флаг снимается до раскладки: новые рецепты за это время разложит
+    fan_out_recipe, повторы push_recipes пропустит.
+    Возвращает кол-во таких авторов.
+    """
+    author_ids = list(User.objects.filter(
+        timeline_pulled=True, followers_count__lt=PUSH_FOLLOWERS
+    ).values_list('pk', flat=True))
+    User.objects.filter(pk__in=author_ids).update(timeline_pulled=False)
+    push_authors(author_ids)
+    return len(author_ids)
+
+
+def rebuild_timelines():
+    """ Пересчитать подписчиков и собрать ленты заново
+
+    Подмешиваемый автор остается таким, пока подписчиков
+    не меньше PUSH_FOLLOWERS.
+    Возвращает кол-во авторов, рецепты которых разложены по лентам.
+    """
+    was_pulled = set(User.objects.filter(
+        timeline_pulled=True
+    ).values_list('pk', flat=True))
+    User.objects.update(followers_count=0, timeline_pulled=False)
+    counts = Follow.objects.order_by().values('following').annotate(
+        total=Count('pk')
+    ).values_list('following', 'total')
+    pushed = []
+    for author_id, total in list(counts):
+        pulled = total >= PULL_FOLLOWERS or (
+            author_id in was_pulled and total >= PUSH_FOLLOWERS
+        )
+        User.objects.filter(pk=author_id).update(
+            followers_count=total, timeline_pulled=pulled
+        )
+        if not pulled:
+            pushed.append(author_id)
+    TimelineEntry.objects.all().delete()
+    push_authors(pushed)
+    return len(pushed)
+
+
+def older_than(position, pk_field):
+    """ Записи ленты после позиции курсора (pub_date, id)"""
+    if position is None:
+        return Q()
+    pub_date, pk = position
+    return Q(pub_date__lt=pub_date) | Q(
+        pub_date=pub_date, **{f'{pk_field}__lt': pk}
+    )
+
+
+def pulled_authors(user):
+    """ Авторы из подписок юзера, чьи рецепты читаются напрямую"""
+    return list(User.objects.filter(
+        pk__in=Follow.objects.filter(user=user).values('following'),
+        timeline_pulled=True
+    ).values_list('pk', flat=True))
+
+
+def read_timeline(user, limit, position=None):
+    """ Позиции (pub_date, id) следующих limit рецептов ленты
+
+    Гибрид: записи TimelineEntry юзера сливаются с новыми рецептами
+    подмешиваемых авторов, оба потока уже отсортированы по убыванию.
+    """
+    pulled = pulled_authors(user)
+    streams = [
+        TimelineEntry.objects.filter(older_than(position, 'recipe'))
+        .filter(user=user).exclude(author__in=pulled)
+        .order_by('-pub_date', '-recipe')
+        .values_list('pub_date', 'recipe')[:limit]
+    ]
+    if pulled:
+        streams.append(
+            Recipe.objects.filter(older_than(position, 'pk'))
+            .filter(author__in=pulled)
+            .order_by('-pub_date', '-pk')
+            .values_list('pub_date', 'pk')[:limit]
+        )
+    return list(islice(merge(*streams, reverse=True), limit))
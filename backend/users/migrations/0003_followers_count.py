@@ -0,0 +1,48 @@
+# Generated by Django 3.2.3 on 2026-10-18 19:38
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# Как recipes.timeline на момент миграции
+PULL_FOLLOWERS = 1000
+
+
+def fill_followers_count(apps, schema_editor):
+    User = apps.get_model('users', 'User')
+    Follow = apps.get_model('users', 'Follow')
+    User.objects.update(followers_count=Coalesce(
+        Subquery(
+            Follow.objects.filter(following=OuterRef('pk'))
+            .order_by().values('following')
+            .annotate(total=Count('pk')).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    ))
+    User.objects.filter(followers_count__gte=PULL_FOLLOWERS).update(
+        timeline_pulled=True
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_auto_20240319_0803'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='followers_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='Подписчики (кол-во)'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='timeline_pulled',
+            field=models.BooleanField(default=False, verbose_name='Рецепты подмешиваются в ленты при чтении'),
+        ),
+        migrations.RunPython(
+            fill_followers_count, migrations.RunPython.noop
+        ),
+    ]
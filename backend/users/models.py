@@ -7,6 +7,14 @@ class User(AbstractUser):
     first_name = models.CharField(('first name'), max_length=150)
     last_name = models.CharField(('last name'), max_length=150)
     email = models.EmailField(('email address'), unique=True)
+    followers_count = models.PositiveIntegerField(
+        'Подписчики (кол-во)',
+        default=0
+    )
+    timeline_pulled = models.BooleanField(
+        'Рецепты подмешиваются в ленты при чтении',
+        default=False
+    )
 
     REQUIRED_FIELDS = ['email', 'first_name', 'last_name']
 